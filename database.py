@@ -5,11 +5,16 @@ Database Initialization Module
 
 import sqlite3
 import hashlib
+import functools
+import queue
+import threading
 import sys
 import os
 from pathlib import Path
+from contextlib import contextmanager
 
 
+@functools.lru_cache(maxsize=1)
 def get_app_data_path():
     """Get persistent path for app data that works with PyInstaller."""
     if getattr(sys, 'frozen', False):
@@ -30,8 +35,21 @@ def get_app_data_path():
         return Path(__file__).parent / "clinic.db"
 
 
-# Database file path
-DB_PATH = get_app_data_path()
+# Database file path, resolved on first use so importing this module
+# doesn't touch the filesystem
+DB_PATH = None
+
+
+def get_db_path():
+    """Get the database file path, resolving it on first call."""
+    global DB_PATH
+    if DB_PATH is None:
+        DB_PATH = get_app_data_path()
+    return DB_PATH
+
+
+# SHA-256 of the default admin password "123"
+_DEFAULT_ADMIN_HASH = "a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3"
 
 
 def hash_password(password: str) -> str:
@@ -39,142 +57,530 @@ def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
 
-def get_connection():
-    """Get optimized database connection."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Table definitions, run as a single script in one transaction
+_SCHEMA_SQL = """
+BEGIN;
+
+-- Users
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    full_name TEXT NOT NULL
+);
+
+-- Patients
+CREATE TABLE IF NOT EXISTS patients (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    age INTEGER,
+    contact TEXT,
+    gender TEXT,
+    occupation TEXT,
+    marital_status TEXT,
+    address TEXT
+);
+
+-- Visits
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    vitals_bp TEXT,
+    vitals_weight REAL,
+    vitals_temp REAL,
+    vitals_bsr TEXT,
+    vitals_spo2 TEXT,
+    vitals_heart_rate TEXT,
+    presenting_complaint TEXT,
+    signs_symptoms TEXT,
+    history_presenting_illness TEXT,
+    past_medical_hx TEXT,
+    family_history TEXT,
+    examination TEXT,
+    differentials TEXT,
+    treatment_plan TEXT,
+    FOREIGN KEY (patient_id) REFERENCES patients (id)
+);
+
+-- Inventory
+CREATE TABLE IF NOT EXISTS inventory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    brand_name TEXT NOT NULL,
+    formula TEXT,
+    stock INTEGER DEFAULT 0,
+    price REAL DEFAULT 0.0
+);
+
+-- Finance
+CREATE TABLE IF NOT EXISTS finance (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    type TEXT CHECK(type IN ('Income', 'Expense')) NOT NULL,
+    amount REAL NOT NULL,
+    notes TEXT
+);
+
+-- Prescriptions (medicines prescribed per visit)
+CREATE TABLE IF NOT EXISTS prescriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    visit_id INTEGER NOT NULL,
+    medicine_name TEXT NOT NULL,
+    dosage TEXT,
+    duration TEXT,
+    quantity INTEGER DEFAULT 1,
+    price REAL DEFAULT 0.0,
+    FOREIGN KEY (visit_id) REFERENCES visits (id)
+);
+
+-- Per-day visit count and income, maintained by triggers (see _STATS_SQL)
+CREATE TABLE IF NOT EXISTS daily_stats (
+    date TEXT PRIMARY KEY,
+    visit_count INTEGER NOT NULL DEFAULT 0,
+    income_total REAL NOT NULL DEFAULT 0
+);
+
+-- Named running counters (e.g. 'low_stock'), maintained by triggers
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+
+COMMIT;
+"""
+
+# Indexes, created separately so bulk loads can defer them
+_INDEX_SQL = """
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name);
+CREATE INDEX IF NOT EXISTS idx_patients_contact ON patients(contact);
+CREATE INDEX IF NOT EXISTS idx_visits_patient_date ON visits(patient_id, date DESC);
+CREATE INDEX IF NOT EXISTS idx_visits_date ON visits(date);
+CREATE INDEX IF NOT EXISTS idx_prescriptions_visit_id ON prescriptions(visit_id);
+CREATE INDEX IF NOT EXISTS idx_finance_date_type ON finance(date, type);
+CREATE INDEX IF NOT EXISTS idx_finance_type ON finance(type);
+CREATE INDEX IF NOT EXISTS idx_inventory_brand_name ON inventory(brand_name);
+CREATE INDEX IF NOT EXISTS idx_inventory_low_stock ON inventory(stock) WHERE stock < 10;
+
+-- Superseded by the composite indexes above
+DROP INDEX IF EXISTS idx_visits_patient_id;
+DROP INDEX IF EXISTS idx_finance_date;
+
+COMMIT;
+"""
+# Triggers that keep daily_stats/stats_counters in step with visits, finance
+# and inventory, so dashboard aggregates are point lookups instead of scans.
+_STATS_SQL = """
+BEGIN;
+
+CREATE TRIGGER IF NOT EXISTS trg_visits_stats_insert AFTER INSERT ON visits
+BEGIN
+    INSERT INTO daily_stats (date, visit_count) VALUES (NEW.date, 1)
+    ON CONFLICT(date) DO UPDATE SET visit_count = visit_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_visits_stats_delete AFTER DELETE ON visits
+BEGIN
+    UPDATE daily_stats SET visit_count = visit_count - 1 WHERE date = OLD.date;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_visits_stats_update AFTER UPDATE OF date ON visits
+BEGIN
+    UPDATE daily_stats SET visit_count = visit_count - 1 WHERE date = OLD.date;
+    INSERT INTO daily_stats (date, visit_count) VALUES (NEW.date, 1)
+    ON CONFLICT(date) DO UPDATE SET visit_count = visit_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_finance_stats_insert AFTER INSERT ON finance
+WHEN NEW.type = 'Income'
+BEGIN
+    INSERT INTO daily_stats (date, income_total) VALUES (NEW.date, NEW.amount)
+    ON CONFLICT(date) DO UPDATE SET income_total = income_total + excluded.income_total;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_finance_stats_delete AFTER DELETE ON finance
+WHEN OLD.type = 'Income'
+BEGIN
+    UPDATE daily_stats SET income_total = income_total - OLD.amount WHERE date = OLD.date;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_finance_stats_update AFTER UPDATE OF date, type, amount ON finance
+BEGIN
+    UPDATE daily_stats SET income_total = income_total - OLD.amount
+    WHERE date = OLD.date AND OLD.type = 'Income';
+    INSERT INTO daily_stats (date, income_total) SELECT NEW.date, NEW.amount WHERE NEW.type = 'Income'
+    ON CONFLICT(date) DO UPDATE SET income_total = income_total + excluded.income_total;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_low_stock_insert AFTER INSERT ON inventory
+WHEN NEW.stock < 10
+BEGIN
+    UPDATE stats_counters SET value = value + 1 WHERE name = 'low_stock';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_low_stock_delete AFTER DELETE ON inventory
+WHEN OLD.stock < 10
+BEGIN
+    UPDATE stats_counters SET value = value - 1 WHERE name = 'low_stock';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_low_stock_update AFTER UPDATE OF stock ON inventory
+WHEN (OLD.stock < 10) IS NOT (NEW.stock < 10)
+BEGIN
+    UPDATE stats_counters
+    SET value = value + (CASE WHEN NEW.stock < 10 THEN 1 WHEN OLD.stock < 10 THEN -1 ELSE 0 END)
+    WHERE name = 'low_stock';
+END;
+
+COMMIT;
+"""
+
+# Trigram FTS5 indexes over the searchable text columns. They are external
+# content tables (the text lives only in patients/inventory) kept in sync by
+# triggers. Trigram matching keeps the substring semantics of the old
+# LIKE '%q%' searches while avoiding a full table scan.
+_SEARCH_SQL = """
+BEGIN;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+    name, contact, address,
+    content='patients', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_patients_fts_insert AFTER INSERT ON patients
+BEGIN
+    INSERT INTO patients_fts (rowid, name, contact, address)
+    VALUES (NEW.id, NEW.name, NEW.contact, NEW.address);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_patients_fts_delete AFTER DELETE ON patients
+BEGIN
+    INSERT INTO patients_fts (patients_fts, rowid, name, contact, address)
+    VALUES ('delete', OLD.id, OLD.name, OLD.contact, OLD.address);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_patients_fts_update AFTER UPDATE OF name, contact, address ON patients
+BEGIN
+    INSERT INTO patients_fts (patients_fts, rowid, name, contact, address)
+    VALUES ('delete', OLD.id, OLD.name, OLD.contact, OLD.address);
+    INSERT INTO patients_fts (rowid, name, contact, address)
+    VALUES (NEW.id, NEW.name, NEW.contact, NEW.address);
+END;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS inventory_fts USING fts5(
+    brand_name, formula,
+    content='inventory', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_fts_insert AFTER INSERT ON inventory
+BEGIN
+    INSERT INTO inventory_fts (rowid, brand_name, formula)
+    VALUES (NEW.id, NEW.brand_name, NEW.formula);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_fts_delete AFTER DELETE ON inventory
+BEGIN
+    INSERT INTO inventory_fts (inventory_fts, rowid, brand_name, formula)
+    VALUES ('delete', OLD.id, OLD.brand_name, OLD.formula);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_fts_update AFTER UPDATE OF brand_name, formula ON inventory
+BEGIN
+    INSERT INTO inventory_fts (inventory_fts, rowid, brand_name, formula)
+    VALUES ('delete', OLD.id, OLD.brand_name, OLD.formula);
+    INSERT INTO inventory_fts (rowid, brand_name, formula)
+    VALUES (NEW.id, NEW.brand_name, NEW.formula);
+END;
+
+COMMIT;
+"""
+
+# Recompute the trigger-maintained tables from scratch. This scans every
+# source table, so it only runs when they may be out of step: on a database
+# whose derived tables predate DERIVED_TABLES_VERSION (fresh file, bulk load
+# done before the triggers existed, older backup) and after a restore.
+_RESYNC_SQL = """
+BEGIN;
+
+DELETE FROM daily_stats;
+INSERT INTO daily_stats (date, visit_count, income_total)
+SELECT date, SUM(visit_count), SUM(income_total) FROM (
+    SELECT date, COUNT(*) AS visit_count, 0 AS income_total FROM visits GROUP BY date
+    UNION ALL
+    SELECT date, 0, SUM(amount) FROM finance WHERE type = 'Income' GROUP BY date
+)
+GROUP BY date;
+
+INSERT OR REPLACE INTO stats_counters (name, value)
+SELECT 'low_stock', COUNT(*) FROM inventory WHERE stock < 10;
+
+INSERT INTO patients_fts (patients_fts) VALUES ('rebuild');
+INSERT INTO inventory_fts (inventory_fts) VALUES ('rebuild');
+
+COMMIT;
+"""
+
+# Stored in PRAGMA user_version once the derived tables are in sync; bump it
+# whenever _STATS_SQL or _SEARCH_SQL change what they maintain
+DERIVED_TABLES_VERSION = 1
+
+# Hot write statements shared by bulk loads and the visit workflow; keeping
+# one string object per statement lets sqlite3's per-connection statement
+# cache reuse the prepared statement on every call
+INSERT_PRESCRIPTION_SQL = """
+    INSERT INTO prescriptions (visit_id, medicine_name, dosage, duration, quantity, price)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+ADJUST_STOCK_SQL = "UPDATE inventory SET stock = stock + ? WHERE id = ?"
+
+
+# Idle connections ready for reuse, so PRAGMA setup runs once per connection
+_pool = queue.SimpleQueue()
+
+# Gate for exclusive_access(): while it is held, new checkouts wait, and the
+# holder waits for connections already lent out to come back
+_gate = threading.Condition()
+_exclusive = False
+_checked_out = 0
+
+# Seconds exclusive_access() waits for lent-out connections before giving up
+EXCLUSIVE_TIMEOUT = 30
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connection whose close() returns it to the pool instead of closing it."""
+
+    def close(self):
+        global _checked_out
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = sqlite3.Row
+        _pool.put(self)
+        with _gate:
+            _checked_out -= 1
+            _gate.notify_all()
+
+
+def _open_connection():
+    """Open a new physical connection and apply the connection PRAGMAs."""
+    conn = sqlite3.connect(get_db_path(), check_same_thread=False, factory=PooledConnection)
     conn.row_factory = sqlite3.Row
-    # Enable WAL mode for better concurrent access
-    conn.execute("PRAGMA journal_mode=WAL")
-    # Enable foreign keys
-    conn.execute("PRAGMA foreign_keys=ON")
-    # Optimize for speed
-    conn.execute("PRAGMA synchronous=NORMAL")
-    conn.execute("PRAGMA cache_size=10000")
-    conn.execute("PRAGMA temp_store=MEMORY")
+    # Enable foreign keys and optimize for speed; the whole clinic database
+    # fits in the 256 MB memory map, so reads skip read() syscalls
+    conn.executescript("""
+        PRAGMA foreign_keys=ON;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=10000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA wal_autocheckpoint=1000;
+    """)
     return conn
 
 
-def init_database():
-    """Initialize the database with all required tables."""
+def get_connection():
+    """Get optimized database connection from the pool.
+
+    Blocks while exclusive_access() is held (e.g. during a restore).
+    """
+    global _checked_out
+    with _gate:
+        while _exclusive:
+            _gate.wait()
+        _checked_out += 1
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return _open_connection()
+    except Exception:
+        with _gate:
+            _checked_out -= 1
+            _gate.notify_all()
+        raise
+
+
+def close_all_connections():
+    """Really close every idle pooled connection (e.g. before a restore)."""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        sqlite3.Connection.close(conn)
+
+
+@contextmanager
+def exclusive_access(timeout=EXCLUSIVE_TIMEOUT):
+    """Hold off new checkouts, wait for lent-out connections, then close the pool.
+
+    Inside the block no pooled connection is open, so the database file can
+    be replaced safely. Raises TimeoutError if requests still hold
+    connections after `timeout` seconds.
+    """
+    global _exclusive
+    with _gate:
+        if _exclusive:
+            raise RuntimeError("Database is already locked for maintenance")
+        _exclusive = True
+        try:
+            if not _gate.wait_for(lambda: _checked_out == 0, timeout):
+                raise TimeoutError("Database is still in use, please try again")
+            close_all_connections()
+            yield
+        finally:
+            _exclusive = False
+            _gate.notify_all()
+
+
+def backup_database(dest_path, pages=1000):
+    """Copy the live database to dest_path with SQLite's online backup API.
+
+    Unlike a plain file copy this includes pages still sitting in the
+    -wal file and yields a consistent snapshot while the app keeps writing.
+    """
+    src = get_connection()
+    dst = sqlite3.connect(str(dest_path))
+    try:
+        src.backup(dst, pages=pages)
+    finally:
+        dst.close()
+        src.close()
+
+
+def restore_database(src_path):
+    """Replace the live database's contents with src_path via the backup API.
+
+    SQLite writes the pages itself, so no stale -wal/-shm file can be
+    replayed over the result. The copy runs in rollback-journal mode
+    because a WAL database only accepts a backup with its own page size.
+    """
+    with exclusive_access():
+        src = sqlite3.connect(str(src_path))
+        dst = sqlite3.connect(get_db_path())
+        try:
+            dst.execute("PRAGMA journal_mode=DELETE")
+            src.backup(dst)
+            dst.execute("PRAGMA journal_mode=WAL")
+        finally:
+            dst.close()
+            src.close()
+
+
+def init_pragmas():
+    """Apply PRAGMAs that persist in the database file itself.
+
+    page_size only takes effect on a fresh file and must be set before
+    switching to WAL; journal_mode=WAL then sticks for every later
+    connection, so neither needs to run per connection.
+    """
     conn = get_connection()
-    cursor = conn.cursor()
+    conn.execute("PRAGMA page_size=8192")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
 
-    # Create users table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            full_name TEXT NOT NULL
-        )
-    """)
 
-    # Create patients table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            age INTEGER,
-            contact TEXT,
-            gender TEXT,
-            occupation TEXT,
-            marital_status TEXT,
-            address TEXT
-        )
-    """)
+def create_schema():
+    """Create all tables (without indexes)."""
+    init_pragmas()
+    conn = get_connection()
+    conn.executescript(_SCHEMA_SQL)
+    conn.close()
 
-    # Create visits table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS visits (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER NOT NULL,
-            date TEXT NOT NULL,
-            vitals_bp TEXT,
-            vitals_weight REAL,
-            vitals_temp REAL,
-            vitals_bsr TEXT,
-            vitals_spo2 TEXT,
-            vitals_heart_rate TEXT,
-            presenting_complaint TEXT,
-            signs_symptoms TEXT,
-            history_presenting_illness TEXT,
-            past_medical_hx TEXT,
-            family_history TEXT,
-            examination TEXT,
-            differentials TEXT,
-            treatment_plan TEXT,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    """)
 
-    # Create inventory table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS inventory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            brand_name TEXT NOT NULL,
-            formula TEXT,
-            stock INTEGER DEFAULT 0,
-            price REAL DEFAULT 0.0
-        )
-    """)
+def create_indexes():
+    """Create indexes for faster queries.
 
-    # Create finance table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS finance (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL,
-            type TEXT CHECK(type IN ('Income', 'Expense')) NOT NULL,
-            amount REAL NOT NULL,
-            notes TEXT
-        )
-    """)
+    Kept separate from create_schema() so bulk loads can insert into
+    un-indexed tables and build each index once afterwards.
+    """
+    conn = get_connection()
+    conn.executescript(_INDEX_SQL)
+    conn.close()
 
-    # Create prescriptions table (medicines prescribed per visit)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS prescriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            visit_id INTEGER NOT NULL,
-            medicine_name TEXT NOT NULL,
-            dosage TEXT,
-            duration TEXT,
-            quantity INTEGER DEFAULT 1,
-            price REAL DEFAULT 0.0,
-            FOREIGN KEY (visit_id) REFERENCES visits (id)
-        )
-    """)
 
-    # Create indexes for faster queries
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patients_contact ON patients(contact)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_patient_id ON visits(patient_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_date ON visits(date)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prescriptions_visit_id ON prescriptions(visit_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_finance_date ON finance(date)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_finance_type ON finance(type)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inventory_brand_name ON inventory(brand_name)")
+def create_stats_triggers():
+    """Create the dashboard stats tables' sync triggers."""
+    conn = get_connection()
+    conn.executescript(_STATS_SQL)
+    conn.close()
 
-    conn.commit()
 
-    # Check if users table is empty and insert default admin
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]
+def create_search_indexes():
+    """Create the FTS5 search tables and their sync triggers."""
+    conn = get_connection()
+    conn.executescript(_SEARCH_SQL)
+    conn.close()
+
+
+def resync_derived_tables():
+    """Rebuild the stats and search tables from the source tables."""
+    conn = get_connection()
+    conn.executescript(_RESYNC_SQL)
+    conn.execute(f"PRAGMA user_version = {DERIVED_TABLES_VERSION}")
+    conn.close()
+
+
+def init_database(resync=False):
+    """Initialize the database with all required tables.
+
+    The derived stats/search tables are only rebuilt when resync is set or
+    the file's user_version shows they may be stale, so a normal start does
+    no full-table scans.
+    """
+    create_schema()
+    create_indexes()
+    create_stats_triggers()
+    create_search_indexes()
+
+    conn = get_connection()
+    if resync or conn.execute("PRAGMA user_version").fetchone()[0] < DERIVED_TABLES_VERSION:
+        resync_derived_tables()
+
+    cursor = conn.cursor()
+
+    # Insert default admin; the UNIQUE username makes this a no-op once seeded
+    cursor.execute("""
+        INSERT OR IGNORE INTO users (username, password_hash, full_name)
+        VALUES (?, ?, ?)
+    """, ("admin", _DEFAULT_ADMIN_HASH, "Dr. Khan"))
+    conn.commit()
 
-    if user_count == 0:
-        default_password_hash = hash_password("123")
-        cursor.execute("""
-            INSERT INTO users (username, password_hash, full_name)
-            VALUES (?, ?, ?)
-        """, ("admin", default_password_hash, "Dr. Khan"))
-        conn.commit()
+    # Refresh planner statistics where they are missing or stale
+    cursor.execute("PRAGMA optimize")
 
     conn.close()
     print("Database Ready")
 
 
+# ============ Test Data Constants ============
+# Inventory IDs of the seeded medicines
+_MED_IDS = tuple(range(1, 26))
+_DOSAGES = ("1+1+1", "1+0+1", "0+0+1", "1+0+0", "1+1+1+1", "SOS")
+_DURATIONS = ("3 days", "5 days", "7 days", "10 days", "14 days")
+# (presenting complaint, signs & symptoms, differentials, treatment plan)
+_COMPLAINTS = (
+    ("Fever and body ache", "High grade fever, myalgia, fatigue", "Viral Fever, Dengue", "Rest, fluids, antipyretics"),
+    ("Cough and cold", "Runny nose, sore throat, mild fever", "URTI, Common Cold", "Symptomatic treatment, steam inhalation"),
+    ("Abdominal pain", "Epigastric pain, nausea, bloating", "Gastritis, Peptic Ulcer", "PPI, antacids, dietary modification"),
+    ("Headache", "Throbbing headache, photophobia", "Migraine, Tension Headache", "Analgesics, rest in dark room"),
+    ("Loose motions", "Watery stools, cramping, dehydration", "Acute Gastroenteritis, Food Poisoning", "ORS, antibiotics if needed"),
+    ("Back pain", "Lower back pain, radiating to legs", "Lumbar Strain, Disc Problem", "Rest, analgesics, physiotherapy"),
+    ("Skin rash", "Itchy red rash on arms", "Allergic Dermatitis, Eczema", "Antihistamines, topical steroids"),
+    ("Shortness of breath", "Dyspnea on exertion, wheezing", "Asthma, COPD", "Bronchodilators, steroids"),
+    ("Sore throat", "Pain on swallowing, fever", "Pharyngitis, Tonsillitis", "Antibiotics, gargles, rest"),
+    ("Joint pain", "Multiple joint pain, stiffness", "Arthritis, Viral Arthralgia", "NSAIDs, rest, hot fomentation"),
+)
+
+
 def add_test_data():
     """Add comprehensive test data for all tables."""
     conn = get_connection()
     cursor = conn.cursor()
+    # Internal bulk-load queries only need plain tuples, not sqlite3.Row
+    cursor.row_factory = None
     
     # Check if test data already exists
     cursor.execute("SELECT COUNT(*) FROM patients")
@@ -183,6 +589,7 @@ def add_test_data():
         conn.close()
         return
     
+    from collections import Counter
     from datetime import date, timedelta
     import random
     
@@ -217,11 +624,13 @@ def add_test_data():
         ("Norflox 400mg", "Norfloxacin", 50, 48),
     ]
     
-    for med in medicines:
-        cursor.execute("""
-            INSERT INTO inventory (brand_name, formula, stock, price)
-            VALUES (?, ?, ?, ?)
-        """, med)
+    # Load everything in one explicit transaction instead of one per row
+    cursor.execute("BEGIN")
+    
+    cursor.executemany("""
+        INSERT INTO inventory (brand_name, formula, stock, price)
+        VALUES (?, ?, ?, ?)
+    """, medicines)
     
     # ============ PATIENTS ============
     patients_data = [
@@ -247,89 +656,87 @@ def add_test_data():
         ("Saima Noor", 50, "0320-1234567", "Female", "Tailor", "Married", "Shop 23, Liberty Market"),
     ]
     
-    for patient in patients_data:
-        cursor.execute("""
-            INSERT INTO patients (name, age, contact, gender, occupation, marital_status, address)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, patient)
+    cursor.executemany("""
+        INSERT INTO patients (name, age, contact, gender, occupation, marital_status, address)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, patients_data)
     
     # ============ VISITS ============
-    complaints = [
-        ("Fever and body ache", "High grade fever, myalgia, fatigue", "Viral Fever, Dengue", "Rest, fluids, antipyretics"),
-        ("Cough and cold", "Runny nose, sore throat, mild fever", "URTI, Common Cold", "Symptomatic treatment, steam inhalation"),
-        ("Abdominal pain", "Epigastric pain, nausea, bloating", "Gastritis, Peptic Ulcer", "PPI, antacids, dietary modification"),
-        ("Headache", "Throbbing headache, photophobia", "Migraine, Tension Headache", "Analgesics, rest in dark room"),
-        ("Loose motions", "Watery stools, cramping, dehydration", "Acute Gastroenteritis, Food Poisoning", "ORS, antibiotics if needed"),
-        ("Back pain", "Lower back pain, radiating to legs", "Lumbar Strain, Disc Problem", "Rest, analgesics, physiotherapy"),
-        ("Skin rash", "Itchy red rash on arms", "Allergic Dermatitis, Eczema", "Antihistamines, topical steroids"),
-        ("Shortness of breath", "Dyspnea on exertion, wheezing", "Asthma, COPD", "Bronchodilators, steroids"),
-        ("Sore throat", "Pain on swallowing, fever", "Pharyngitis, Tonsillitis", "Antibiotics, gargles, rest"),
-        ("Joint pain", "Multiple joint pain, stiffness", "Arthritis, Viral Arthralgia", "NSAIDs, rest, hot fomentation"),
+    
+    # Look up medicine names/prices once instead of per prescription
+    inventory_lookup = {
+        med_id: (brand_name, price)
+        for med_id, brand_name, price in cursor.execute("SELECT id, brand_name, price FROM inventory")
+    }
+    
+    # Create visits for the last 30 days (1-4 visits per day)
+    visit_dates = [
+        (today - timedelta(days=day_offset)).isoformat()
+        for day_offset, num_visits in zip(range(30, -1, -1), random.choices(range(1, 5), k=31))
+        for _ in range(num_visits)
     ]
+    n = len(visit_dates)
     
-    # Create visits for the last 30 days
-    visit_id = 1
-    for day_offset in range(30, -1, -1):
-        visit_date = (today - timedelta(days=day_offset)).isoformat()
-        
-        # 1-4 visits per day
-        num_visits = random.randint(1, 4)
-        for _ in range(num_visits):
-            patient_id = random.randint(1, 20)
-            complaint = random.choice(complaints)
-            
-            bp = f"{random.randint(110, 140)}/{random.randint(70, 90)}"
-            weight = round(random.uniform(45, 95), 1)
-            temp = round(random.uniform(98, 102), 1)
-            bsr = f"{random.randint(80, 140)} mg/dL"
-            spo2 = f"{random.randint(95, 99)}%"
-            hr = f"{random.randint(65, 100)} bpm"
-            
-            cursor.execute("""
-                INSERT INTO visits (patient_id, date, vitals_bp, vitals_weight, vitals_temp,
-                    vitals_bsr, vitals_spo2, vitals_heart_rate, presenting_complaint,
-                    signs_symptoms, differentials, treatment_plan)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (patient_id, visit_date, bp, weight, temp, bsr, spo2, hr,
-                  complaint[0], complaint[1], complaint[2], complaint[3]))
-            
-            current_visit_id = cursor.lastrowid
-            
-            # Add 1-4 prescriptions per visit
-            num_meds = random.randint(1, 4)
-            used_meds = random.sample(range(1, 26), num_meds)
-            
-            dosages = ["1+1+1", "1+0+1", "0+0+1", "1+0+0", "1+1+1+1", "SOS"]
-            durations = ["3 days", "5 days", "7 days", "10 days", "14 days"]
+    # Draw each random field for all visits at once rather than per visit
+    patient_ids = random.choices(range(1, 21), k=n)
+    visit_complaints = random.choices(_COMPLAINTS, k=n)
+    bps = [f"{sys_bp}/{dia_bp}" for sys_bp, dia_bp in
+           zip(random.choices(range(110, 141), k=n), random.choices(range(70, 91), k=n))]
+    weights = [round(random.uniform(45, 95), 1) for _ in range(n)]
+    temps = [round(random.uniform(98, 102), 1) for _ in range(n)]
+    bsrs = [f"{v} mg/dL" for v in random.choices(range(80, 141), k=n)]
+    spo2s = [f"{v}%" for v in random.choices(range(95, 100), k=n)]
+    hrs = [f"{v} bpm" for v in random.choices(range(65, 101), k=n)]
+    
+    # Visit IDs are assigned up front so prescription rows can reference them
+    # without a lastrowid round-trip per visit
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM visits")
+    first_visit_id = cursor.fetchone()[0] + 1
+    visit_ids = range(first_visit_id, first_visit_id + n)
+    visit_rows = [
+        (visit_id, patient_id, visit_date, bp, weight, temp, bsr, spo2, hr, *complaint)
+        for visit_id, patient_id, visit_date, bp, weight, temp, bsr, spo2, hr, complaint
+        in zip(visit_ids, patient_ids, visit_dates, bps, weights, temps, bsrs, spo2s, hrs, visit_complaints)
+    ]
+    
+    presc_rows = []
+    # Net stock change per medicine, applied in one batch at the end
+    stock_delta = Counter()
+    
+    # Add 1-4 prescriptions per visit
+    for visit_id, num_meds in zip(visit_ids, random.choices(range(1, 5), k=n)):
+        for med_id in random.sample(_MED_IDS, num_meds):
+            med = inventory_lookup[med_id]
+            qty = random.randint(5, 20)
             
-            for med_id in used_meds:
-                cursor.execute("SELECT brand_name, price FROM inventory WHERE id = ?", (med_id,))
-                med = cursor.fetchone()
-                qty = random.randint(5, 20)
-                
-                cursor.execute("""
-                    INSERT INTO prescriptions (visit_id, medicine_name, dosage, duration, quantity, price)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (current_visit_id, med[0], random.choice(dosages), random.choice(durations), qty, med[1]))
-                
-                # Deduct from inventory
-                cursor.execute("UPDATE inventory SET stock = stock - ? WHERE id = ?", (qty, med_id))
+            presc_rows.append((visit_id, med[0], random.choice(_DOSAGES), random.choice(_DURATIONS), qty, med[1]))
             
-            visit_id += 1
+            # Deduct from inventory
+            stock_delta[med_id] -= qty
+    
+    cursor.executemany("""
+        INSERT INTO visits (id, patient_id, date, vitals_bp, vitals_weight, vitals_temp,
+            vitals_bsr, vitals_spo2, vitals_heart_rate, presenting_complaint,
+            signs_symptoms, differentials, treatment_plan)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, visit_rows)
+    
+    cursor.executemany(INSERT_PRESCRIPTION_SQL, presc_rows)
     
     # ============ FINANCE ============
-    # Add income entries
-    for day_offset in range(30, -1, -1):
-        finance_date = (today - timedelta(days=day_offset)).isoformat()
-        
-        # Consultation fees (1-4 per day)
-        num_consultations = random.randint(1, 4)
-        for i in range(num_consultations):
-            amount = random.choice([500, 700, 1000, 1500])
-            cursor.execute("""
-                INSERT INTO finance (date, type, amount, notes)
-                VALUES (?, 'Income', ?, ?)
-            """, (finance_date, amount, f"Consultation Fee - Patient #{random.randint(1, 20)}"))
+    # Add income entries: consultation fees (1-4 per day)
+    income_dates = [
+        (today - timedelta(days=day_offset)).isoformat()
+        for day_offset, num_consultations in zip(range(30, -1, -1), random.choices(range(1, 5), k=31))
+        for _ in range(num_consultations)
+    ]
+    m = len(income_dates)
+    fee_amounts = random.choices((500, 700, 1000, 1500), k=m)
+    fee_notes = ["Consultation Fee - Patient #%d" % patient_id for patient_id in random.choices(range(1, 21), k=m)]
+    finance_rows = [
+        (finance_date, 'Income', amount, note)
+        for finance_date, amount, note in zip(income_dates, fee_amounts, fee_notes)
+    ]
     
     # Add expense entries
     expenses = [
@@ -347,24 +754,25 @@ def add_test_data():
         expense_date = (today - timedelta(days=day_offset)).isoformat()
         expense = random.choice(expenses)
         amount = random.randint(expense[1], expense[2])
-        cursor.execute("""
-            INSERT INTO finance (date, type, amount, notes)
-            VALUES (?, 'Expense', ?, ?)
-        """, (expense_date, amount, expense[0]))
+        finance_rows.append((expense_date, 'Expense', amount, expense[0]))
     
     # Restock inventory with expenses
     for day_offset in [25, 15, 5]:
         restock_date = (today - timedelta(days=day_offset)).isoformat()
         restock_amount = random.randint(5000, 15000)
-        cursor.execute("""
-            INSERT INTO finance (date, type, amount, notes)
-            VALUES (?, 'Expense', ?, ?)
-        """, (restock_date, restock_amount, "Medicine Stock Purchase"))
+        finance_rows.append((restock_date, 'Expense', restock_amount, "Medicine Stock Purchase"))
         
         # Actually add stock
-        for med_id in random.sample(range(1, 26), 10):
-            cursor.execute("UPDATE inventory SET stock = stock + ? WHERE id = ?", 
-                          (random.randint(20, 50), med_id))
+        for med_id in random.sample(_MED_IDS, 10):
+            stock_delta[med_id] += random.randint(20, 50)
+    
+    cursor.executemany("""
+        INSERT INTO finance (date, type, amount, notes)
+        VALUES (?, ?, ?, ?)
+    """, finance_rows)
+    
+    cursor.executemany(ADJUST_STOCK_SQL,
+                       [(delta, med_id) for med_id, delta in stock_delta.items() if delta])
     
     conn.commit()
     conn.close()
@@ -372,5 +780,14 @@ def add_test_data():
 
 
 if __name__ == "__main__":
-    init_database()
+    # Bulk-load into un-indexed tables; init_database() then builds the
+    # indexes in one pass, resyncs the stats and search tables and seeds the
+    # admin user
+    create_schema()
     add_test_data()
+    init_database(resync=True)
+    
+    # Planner statistics for the loaded tables, now that their indexes exist
+    conn = get_connection()
+    conn.execute("ANALYZE")
+    conn.close()
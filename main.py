@@ -3,25 +3,50 @@ DrKhan Hospital Management System
 Main Application Entry Point
 """
 
+import asyncio
 import uvicorn
 import webview
+import webbrowser
 import threading
-import shutil
 import os
-from datetime import date, datetime
+import time
+import functools
+import secrets
+import subprocess
+import platform
+import socket
+import orjson
+from collections import Counter, defaultdict, namedtuple
+from datetime import date, datetime, timedelta
 from pathlib import Path
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from urllib.parse import quote
+from fpdf import FPDF
+from fastapi import FastAPI, APIRouter, Request, HTTPException, Depends, Body, Query
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.middleware.sessions import SessionMiddleware
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from typing import List, Optional
 
-from database import init_database, get_connection, hash_password
-from prescription import generate_prescription_pdf, generate_and_open_prescription
+from database import (
+    init_database, get_connection, get_db_path, hash_password, backup_database, restore_database,
+    INSERT_PRESCRIPTION_SQL, ADJUST_STOCK_SQL
+)
+from prescription import (
+    generate_prescription_pdf, generate_and_open_prescription, render_prescription_pdf,
+    VITAL_LABELS_LONG, VITAL_UNITS, get_vitals
+)
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (much faster than stdlib json)."""
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
 
 # Initialize FastAPI app
-app = FastAPI(title="DrKhan Clinic", version="1.0.0")
+app = FastAPI(title="DrKhan Clinic", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Paths
 BASE_DIR = Path(__file__).parent
@@ -34,8 +59,11 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 # Templates
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
-# Simple session storage (in-memory for single user)
-session = {"logged_in": False, "user": None}
+# Signed-cookie sessions (request.session). The key is generated per process,
+# so logging in again after a restart is required, as with the old in-memory
+# session; set DRKHAN_SESSION_SECRET to share sessions across workers.
+SESSION_SECRET = os.environ.get("DRKHAN_SESSION_SECRET") or secrets.token_hex(32)
+app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET, same_site="strict")
 
 
 # ============ Pydantic Models ============
@@ -81,36 +109,170 @@ class VisitCreate(BaseModel):
     medicines: List[MedicineItem] = []
 
 
+# ============ Dependencies ============
+def get_db():
+    """Lend the request a pooled connection and hand it back afterwards.
+
+    A plain generator, so FastAPI runs it in the threadpool: the checkout can
+    block while a restore holds the database.
+    """
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
 # ============ Auth Helpers ============
-def check_auth():
-    """Check if user is logged in."""
-    if not session.get("logged_in"):
+async def check_auth(request: Request):
+    """Check if user is logged in (async, so it runs inline rather than in the threadpool)."""
+    if not request.session.get("logged_in"):
         raise HTTPException(status_code=401, detail="Not authenticated")
-    return session["user"]
+    return request.session["user"]
 
 
-def get_current_user():
+def get_current_user(request: Request):
     """Get current logged in user or None."""
-    if session.get("logged_in"):
-        return session["user"]
+    if request.session.get("logged_in"):
+        return request.session["user"]
     return None
 
 
+# ============ Response Cache ============
+# In-process TTL cache for the read endpoints the dashboard polls. Each entry
+# is tagged with the tables it reads; write paths call invalidate() with the
+# tables they touch so cached responses never outlive the data behind them.
+_cache = {}
+_cache_tags = defaultdict(set)
+_cache_generation = 0
+_cache_lock = threading.Lock()
+
+
+def cached(tables, ttl=30):
+    """Cache an endpoint's result per (endpoint, params) for ttl seconds.
+    
+    With ttl=None the entry never expires and lives until invalidate()
+    drops it, for data that only changes through this app's own writes.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            params = sorted((k, v) for k, v in kwargs.items() if k != "conn")
+            key = (func.__name__, tuple(params))
+            now = time.monotonic()
+            with _cache_lock:
+                entry = _cache.get(key)
+                generation = _cache_generation
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            
+            value = func(*args, **kwargs)
+            
+            with _cache_lock:
+                # Skip storing if a write invalidated the cache meanwhile
+                if generation == _cache_generation:
+                    expiry = now + ttl if ttl is not None else float("inf")
+                    _cache[key] = (expiry, value)
+                    for table in tables:
+                        _cache_tags[table].add(key)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate(tables=None):
+    """Drop cached responses that read any of the given tables (all if None)."""
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        if tables is None:
+            _cache.clear()
+            _cache_tags.clear()
+            return
+        for table in tables:
+            for key in _cache_tags.pop(table, ()):
+                _cache.pop(key, None)
+
+
+# ============ Row Helpers ============
+def fetch_rows(cursor, format="columns"):
+    """Fetch remaining rows as {"columns": [...], "rows": [[...], ...]}.
+    
+    Expects a cursor with row_factory = None so rows stay the plain tuples
+    sqlite3 returns and no per-row dict is built. format="aos" returns the
+    older list-of-dicts shape for callers that still expect it.
+    """
+    columns = [col[0] for col in cursor.description]
+    rows = cursor.fetchall()
+    if format == "aos":
+        return [dict(zip(columns, row)) for row in rows]
+    return {"columns": columns, "rows": rows}
+
+
+# ============ Streaming Helpers ============
+# Large lists are streamed in batches so the full result set never has to sit
+# in memory. Streams own their connection (a get_db connection is handed back
+# when the endpoint returns, before the body is sent) and close it when done.
+STREAM_BATCH_SIZE = 512
+
+
+def iter_json_rows(cursor):
+    """Yield a tuple cursor's remaining rows as chunks of a JSON array."""
+    columns = [col[0] for col in cursor.description]
+    yield b"["
+    separator = b""
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        yield separator + b",".join(orjson.dumps(dict(zip(columns, row))) for row in rows)
+        separator = b","
+    yield b"]"
+
+
+def close_after(conn, chunks):
+    """Pass chunks through, returning conn to the pool once streaming ends."""
+    try:
+        yield from chunks
+    finally:
+        conn.close()
+
+
+# ============ Search Helpers ============
+# Trigram FTS5 needs at least three characters to match anything
+FTS_MIN_QUERY = 3
+
+
+def search_clause(fts_table, columns, text):
+    """Return (sql, params) matching text as a substring of any column.
+    
+    Uses the table's trigram FTS5 index when the query is long enough and
+    falls back to LIKE scans for one- and two-character queries.
+    """
+    if len(text) >= FTS_MIN_QUERY:
+        phrase = '"' + text.replace('"', '""') + '"'
+        return f"(id IN (SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH ?))", [phrase]
+    like = f"%{text}%"
+    return "(" + " OR ".join(f"{col} LIKE ?" for col in columns) + ")", [like] * len(columns)
+
+
 # ============ Routes ============
+# Every /api route requires a logged-in session; page routes redirect instead
+api_router = APIRouter(prefix="/api", dependencies=[Depends(check_auth)])
+
 
 @app.get("/", response_class=HTMLResponse)
 async def login_page(request: Request):
     """Serve the login page."""
     # If already logged in, redirect to dashboard
-    if session.get("logged_in"):
+    if request.session.get("logged_in"):
         return RedirectResponse(url="/dashboard", status_code=302)
     return templates.TemplateResponse("login.html", {"request": request})
 
 
 @app.post("/login")
-async def login(credentials: LoginRequest):
+def login(credentials: LoginRequest, request: Request, conn=Depends(get_db)):
     """Verify login credentials."""
-    conn = get_connection()
     cursor = conn.cursor()
     
     # Hash the provided password
@@ -122,12 +284,11 @@ async def login(credentials: LoginRequest):
         (credentials.username, password_hash)
     )
     user = cursor.fetchone()
-    conn.close()
     
     if user:
         # Set session
-        session["logged_in"] = True
-        session["user"] = {
+        request.session["logged_in"] = True
+        request.session["user"] = {
             "id": user["id"],
             "username": user["username"],
             "full_name": user["full_name"]
@@ -135,7 +296,7 @@ async def login(credentials: LoginRequest):
         return JSONResponse({
             "success": True,
             "message": "Login successful",
-            "user": session["user"]
+            "user": request.session["user"]
         })
     else:
         return JSONResponse(
@@ -147,41 +308,33 @@ async def login(credentials: LoginRequest):
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_page(request: Request):
     """Serve the dashboard page (protected)."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
-        "user": session["user"]
+        "user": request.session["user"]
     })
 
 
-@app.get("/api/dashboard")
-async def get_dashboard_stats():
+@api_router.get("/dashboard")
+@cached(tables=("visits", "patients", "finance", "inventory"))
+def get_dashboard_stats(conn=Depends(get_db)):
     """Return dashboard statistics."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     today = date.today().isoformat()
     
-    # Get today's patient/visit count
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM visits WHERE date = ?",
-        (today,)
-    )
-    patients_today = cursor.fetchone()["count"]
-    
-    # Get today's revenue
-    cursor.execute(
-        "SELECT COALESCE(SUM(amount), 0) as total FROM finance WHERE date = ? AND type = 'Income'",
-        (today,)
-    )
-    revenue = cursor.fetchone()["total"]
-    
-    # Get low stock count (items with stock < 10)
-    cursor.execute("SELECT COUNT(*) as count FROM inventory WHERE stock < 10")
-    low_stock = cursor.fetchone()["count"]
+    # Get today's visit count, revenue and low stock count in one round-trip
+    # (all trigger-maintained; low stock means stock < 10)
+    cursor.execute("""
+        SELECT
+            COALESCE(d.visit_count, 0) as patients_today,
+            COALESCE(d.income_total, 0) as revenue,
+            c.value as low_stock
+        FROM stats_counters c
+        LEFT JOIN daily_stats d ON d.date = ?
+        WHERE c.name = 'low_stock'
+    """, (today,))
+    patients_today, revenue, low_stock = cursor.fetchone()
     
     # Get today's visits with patient names
     cursor.execute("""
@@ -198,8 +351,6 @@ async def get_dashboard_stats():
     """, (today,))
     visits = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
-    
     return {
         "patients_today": patients_today,
         "revenue": revenue,
@@ -208,31 +359,21 @@ async def get_dashboard_stats():
     }
 
 
-@app.get("/api/stats")
-async def get_stats():
+@api_router.get("/stats")
+@cached(tables=("visits", "finance"))
+def get_stats(conn=Depends(get_db)):
     """Return today's patient count and revenue for dashboard widgets."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     today = date.today().isoformat()
     
-    # Get today's patient/visit count
+    # Get today's patient/visit count and revenue (trigger-maintained)
     cursor.execute(
-        "SELECT COUNT(*) as count FROM visits WHERE date = ?",
+        "SELECT visit_count, income_total FROM daily_stats WHERE date = ?",
         (today,)
     )
-    patients_today = cursor.fetchone()["count"]
-    
-    # Get today's revenue
-    cursor.execute(
-        "SELECT COALESCE(SUM(amount), 0) as total FROM finance WHERE date = ? AND type = 'Income'",
-        (today,)
-    )
-    revenue = cursor.fetchone()["total"]
-    
-    conn.close()
+    stats = cursor.fetchone()
+    patients_today = stats["visit_count"] if stats else 0
+    revenue = stats["income_total"] if stats else 0
     
     return {
         "patients_today": patients_today,
@@ -241,18 +382,16 @@ async def get_stats():
 
 
 @app.post("/logout")
-async def logout():
+async def logout(request: Request):
     """Log out the user."""
-    session["logged_in"] = False
-    session["user"] = None
+    request.session.clear()
     return JSONResponse({"success": True, "message": "Logged out"})
 
 
 @app.get("/logout")
-async def logout_redirect():
+async def logout_redirect(request: Request):
     """Log out and redirect to login page."""
-    session["logged_in"] = False
-    session["user"] = None
+    request.session.clear()
     return RedirectResponse(url="/", status_code=302)
 
 
@@ -261,21 +400,17 @@ async def logout_redirect():
 @app.get("/visits", response_class=HTMLResponse)
 async def visits_page(request: Request):
     """Serve the visit management page."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return templates.TemplateResponse("visits.html", {
         "request": request,
-        "user": session["user"]
+        "user": request.session["user"]
     })
 
 
-@app.get("/api/visits/all")
-async def get_all_visits(search: str = "", date_filter: str = "", page: int = 1, page_size: int = 20):
+@api_router.get("/visits/all")
+def get_all_visits(search: str = "", date_filter: str = "", page: int = 1, page_size: int = 20, conn=Depends(get_db)):
     """Get all visits with search and pagination."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     # Build date filter
@@ -285,11 +420,9 @@ async def get_all_visits(search: str = "", date_filter: str = "", page: int = 1,
     if date_filter == "today":
         date_condition = f"AND v.date = '{today}'"
     elif date_filter == "week":
-        from datetime import timedelta
         week_ago = (date.today() - timedelta(days=7)).isoformat()
         date_condition = f"AND v.date >= '{week_ago}'"
     elif date_filter == "month":
-        from datetime import timedelta
         month_ago = (date.today() - timedelta(days=30)).isoformat()
         date_condition = f"AND v.date >= '{month_ago}'"
     
@@ -329,7 +462,6 @@ async def get_all_visits(search: str = "", date_filter: str = "", page: int = 1,
     """, (page_size, offset))
     
     visits = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return {
         "visits": visits,
@@ -340,17 +472,13 @@ async def get_all_visits(search: str = "", date_filter: str = "", page: int = 1,
     }
 
 
-@app.get("/api/visits/stats")
-async def get_visits_stats():
+@api_router.get("/visits/stats")
+@cached(tables=("visits",))
+def get_visits_stats(conn=Depends(get_db)):
     """Get visit statistics."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     today = date.today().isoformat()
-    from datetime import timedelta
     week_ago = (date.today() - timedelta(days=7)).isoformat()
     
     # Total visits
@@ -365,8 +493,6 @@ async def get_visits_stats():
     cursor.execute("SELECT COUNT(*) as count FROM visits WHERE date >= ?", (week_ago,))
     week_count = cursor.fetchone()["count"]
     
-    conn.close()
-    
     return {
         "total": total,
         "today": today_count,
@@ -379,54 +505,53 @@ async def get_visits_stats():
 @app.get("/patients", response_class=HTMLResponse)
 async def patients_page(request: Request):
     """Serve the patients management page."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return templates.TemplateResponse("patients.html", {
         "request": request,
-        "user": session["user"]
+        "user": request.session["user"]
     })
 
 
-@app.get("/api/patients")
-async def get_patients(search: str = ""):
-    """Get all patients with optional search."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
+@api_router.get("/patients")
+def get_patients(search: str = "", format: str = "columns", conn=Depends(get_db)):
+    """Get all patients with optional search (columnar unless format=aos)."""
     cursor = conn.cursor()
+    cursor.row_factory = None
     
     if search:
-        cursor.execute("""
+        match_sql, params = search_clause("patients_fts", ("name", "contact", "address"), search)
+        # Purely numeric searches can also be a patient ID
+        search_id = int(search) if search.isdigit() else None
+        cursor.execute(f"""
             SELECT 
                 p.id, p.name, p.age, p.contact, p.gender, p.address,
-                (SELECT MAX(date) FROM visits WHERE patient_id = p.id) as last_visit
+                lv.last_visit
             FROM patients p
-            WHERE p.name LIKE ? OR p.contact LIKE ? OR CAST(p.id AS TEXT) LIKE ? OR p.address LIKE ?
+            LEFT JOIN (
+                SELECT patient_id, MAX(date) as last_visit FROM visits GROUP BY patient_id
+            ) lv ON lv.patient_id = p.id
+            WHERE {match_sql} OR p.id = ?
             ORDER BY p.name
-        """, (f"%{search}%", f"%{search}%", f"%{search}%", f"%{search}%"))
+        """, (*params, search_id))
     else:
         cursor.execute("""
             SELECT 
                 p.id, p.name, p.age, p.contact, p.gender, p.address,
-                (SELECT MAX(date) FROM visits WHERE patient_id = p.id) as last_visit
+                lv.last_visit
             FROM patients p
+            LEFT JOIN (
+                SELECT patient_id, MAX(date) as last_visit FROM visits GROUP BY patient_id
+            ) lv ON lv.patient_id = p.id
             ORDER BY p.id DESC
         """)
     
-    patients = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return patients
+    return fetch_rows(cursor, format)
 
 
-@app.post("/api/patients")
-async def create_patient(patient: PatientCreate):
+@api_router.post("/patients")
+def create_patient(patient: PatientCreate, conn=Depends(get_db)):
     """Create a new patient."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -436,23 +561,18 @@ async def create_patient(patient: PatientCreate):
     
     patient_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+    invalidate(("patients",))
     
     return {"success": True, "patient_id": patient_id, "message": "Patient created successfully"}
 
 
-@app.get("/api/patients/{patient_id}")
-async def get_patient(patient_id: int):
+@api_router.get("/patients/{patient_id}")
+def get_patient(patient_id: int, conn=Depends(get_db)):
     """Get a single patient by ID."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
     patient = cursor.fetchone()
-    conn.close()
     
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
@@ -460,19 +580,14 @@ async def get_patient(patient_id: int):
     return dict(patient)
 
 
-@app.delete("/api/patients/{patient_id}")
-async def delete_patient(patient_id: int):
+@api_router.delete("/patients/{patient_id}")
+def delete_patient(patient_id: int, conn=Depends(get_db)):
     """Delete a patient and all their associated visits and prescriptions."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     # Check if patient exists
     cursor.execute("SELECT id FROM patients WHERE id = ?", (patient_id,))
     if not cursor.fetchone():
-        conn.close()
         raise HTTPException(status_code=404, detail="Patient not found")
     
     # Get all visit IDs for this patient to delete prescriptions
@@ -491,18 +606,14 @@ async def delete_patient(patient_id: int):
     cursor.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
     
     conn.commit()
-    conn.close()
+    invalidate(("patients", "visits"))
     
     return {"success": True, "message": "Patient and all associated records deleted successfully"}
 
 
-@app.get("/api/patients/{patient_id}/history")
-async def get_patient_history(patient_id: int):
+@api_router.get("/patients/{patient_id}/history")
+def get_patient_history(patient_id: int, conn=Depends(get_db)):
     """Get visit history for a patient."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -515,17 +626,13 @@ async def get_patient_history(patient_id: int):
     """, (patient_id,))
     
     visits = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return visits
 
 
-@app.get("/api/patients/{patient_id}/full-record")
-async def get_patient_full_record(patient_id: int):
+@api_router.get("/patients/{patient_id}/full-record")
+def get_patient_full_record(patient_id: int):
     """Get complete patient record including demographics, visits, and prescriptions."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
     conn = get_connection()
     cursor = conn.cursor()
     
@@ -537,9 +644,8 @@ async def get_patient_full_record(patient_id: int):
         conn.close()
         raise HTTPException(status_code=404, detail="Patient not found")
     
-    patient_data = dict(patient)
-    
-    # Get all visits with their prescriptions
+    # Get all visits; prescriptions are attached per batch while streaming
+    cursor.row_factory = None
     cursor.execute("""
         SELECT id, date, vitals_bp, vitals_weight, vitals_temp, vitals_bsr,
             vitals_spo2, vitals_heart_rate, presenting_complaint, signs_symptoms,
@@ -550,104 +656,134 @@ async def get_patient_full_record(patient_id: int):
         ORDER BY date DESC
     """, (patient_id,))
     
-    visits = []
-    for visit_row in cursor.fetchall():
-        visit = dict(visit_row)
-        # Get prescriptions for this visit
-        cursor.execute("""
-            SELECT medicine_name, dosage, duration, quantity, price
-            FROM prescriptions
-            WHERE visit_id = ?
-        """, (visit['id'],))
-        visit['prescriptions'] = [dict(p) for p in cursor.fetchall()]
-        visits.append(visit)
-    
-    conn.close()
+    return StreamingResponse(
+        close_after(conn, iter_patient_record(conn, dict(patient), cursor)),
+        media_type="application/json"
+    )
+
+
+def iter_patient_record(conn, patient, visit_cursor):
+    """Yield {"patient": ..., "visits": [...]} with each visit's prescriptions nested."""
+    columns = [col[0] for col in visit_cursor.description]
+    presc_cursor = conn.cursor()
+    presc_cursor.row_factory = None
     
-    return {
-        "patient": patient_data,
-        "visits": visits
-    }
+    yield b'{"patient":' + orjson.dumps(patient) + b',"visits":['
+    separator = b""
+    while True:
+        visits = [dict(zip(columns, row)) for row in visit_cursor.fetchmany(STREAM_BATCH_SIZE)]
+        if not visits:
+            break
+        
+        # One prescriptions query per batch of visits
+        placeholders = ','.join('?' * len(visits))
+        presc_cursor.execute(f"""
+            SELECT visit_id, medicine_name, dosage, duration, quantity, price
+            FROM prescriptions
+            WHERE visit_id IN ({placeholders})
+        """, [visit["id"] for visit in visits])
+        
+        presc_by_visit = defaultdict(list)
+        for visit_id, medicine_name, dosage, duration, quantity, price in presc_cursor.fetchall():
+            presc_by_visit[visit_id].append({
+                "medicine_name": medicine_name,
+                "dosage": dosage,
+                "duration": duration,
+                "quantity": quantity,
+                "price": price
+            })
+        
+        for visit in visits:
+            visit['prescriptions'] = presc_by_visit.get(visit['id'], [])
+        
+        yield separator + b",".join(orjson.dumps(visit) for visit in visits)
+        separator = b","
+    yield b"]}"
 
 
 # ============ Visit Management Routes ============
 
-@app.post("/api/visits")
-async def create_visit(visit: VisitCreate):
+@api_router.post("/visits")
+def create_visit(visit: VisitCreate, conn=Depends(get_db)):
     """Create a new visit with prescription and auto-billing."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     today = date.today().isoformat()
     
     try:
-        # 1. Create the visit record
-        cursor.execute("""
-            INSERT INTO visits (patient_id, date, vitals_bp, vitals_weight, vitals_temp, vitals_bsr, 
-                vitals_spo2, vitals_heart_rate, presenting_complaint, signs_symptoms, 
-                history_presenting_illness, past_medical_hx, family_history, examination, 
-                differentials, treatment_plan)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            visit.patient_id,
-            today,
-            visit.vitals_bp,
-            visit.vitals_weight,
-            visit.vitals_temp,
-            visit.vitals_bsr,
-            visit.vitals_spo2,
-            visit.vitals_heart_rate,
-            visit.presenting_complaint,
-            visit.signs_symptoms,
-            visit.history_presenting_illness,
-            visit.past_medical_hx,
-            visit.family_history,
-            visit.examination,
-            visit.differentials,
-            visit.treatment_plan
-        ))
-        visit_id = cursor.lastrowid
-        
-        # 2. Process medicines - deduct from inventory and save prescriptions
-        medicine_total = 0
-        for med in visit.medicines:
-            # Check stock availability
-            cursor.execute("SELECT stock, brand_name FROM inventory WHERE id = ?", (med.inventory_id,))
-            item = cursor.fetchone()
+        # One IMMEDIATE transaction: the write lock is taken before the stock
+        # check so validation and deductions see the same inventory, and the
+        # block commits (a single WAL sync) or rolls back as a unit
+        with conn:
+            cursor.execute("BEGIN IMMEDIATE")
             
-            if not item:
-                conn.rollback()
-                raise HTTPException(status_code=400, detail=f"Medicine not found: ID {med.inventory_id}")
-            
-            if item["stock"] < med.quantity:
-                conn.rollback()
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Insufficient stock for {item['brand_name']}. Available: {item['stock']}"
+            # 1. Validate all medicines with one lookup before writing anything
+            items = {}
+            inventory_ids = {med.inventory_id for med in visit.medicines}
+            if inventory_ids:
+                placeholders = ','.join('?' * len(inventory_ids))
+                cursor.execute(
+                    f"SELECT id, stock, brand_name FROM inventory WHERE id IN ({placeholders})",
+                    tuple(inventory_ids)
                 )
+                items = {row["id"]: row for row in cursor.fetchall()}
             
-            # Deduct from inventory
-            cursor.execute("""
-                UPDATE inventory SET stock = stock - ? WHERE id = ?
-            """, (med.quantity, med.inventory_id))
+            remaining = {item_id: item["stock"] for item_id, item in items.items()}
+            stock_used = Counter()
+            for med in visit.medicines:
+                item = items.get(med.inventory_id)
+                if not item:
+                    raise HTTPException(status_code=400, detail=f"Medicine not found: ID {med.inventory_id}")
+                
+                if remaining[med.inventory_id] < med.quantity:
+                    raise HTTPException(
+                        status_code=400, 
+                        detail=f"Insufficient stock for {item['brand_name']}. Available: {remaining[med.inventory_id]}"
+                    )
+                remaining[med.inventory_id] -= med.quantity
+                stock_used[med.inventory_id] += med.quantity
             
-            # Save to prescriptions table
+            # 2. Create the visit record
             cursor.execute("""
-                INSERT INTO prescriptions (visit_id, medicine_name, dosage, duration, quantity, price)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (visit_id, item["brand_name"], med.dosage or "As directed", "7 days", med.quantity, med.price))
+                INSERT INTO visits (patient_id, date, vitals_bp, vitals_weight, vitals_temp, vitals_bsr, 
+                    vitals_spo2, vitals_heart_rate, presenting_complaint, signs_symptoms, 
+                    history_presenting_illness, past_medical_hx, family_history, examination, 
+                    differentials, treatment_plan)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                visit.patient_id,
+                today,
+                visit.vitals_bp,
+                visit.vitals_weight,
+                visit.vitals_temp,
+                visit.vitals_bsr,
+                visit.vitals_spo2,
+                visit.vitals_heart_rate,
+                visit.presenting_complaint,
+                visit.signs_symptoms,
+                visit.history_presenting_illness,
+                visit.past_medical_hx,
+                visit.family_history,
+                visit.examination,
+                visit.differentials,
+                visit.treatment_plan
+            ))
+            visit_id = cursor.lastrowid
             
-            medicine_total += med.price * med.quantity
-        
-        # 3. Calculate total bill (for display only, not added to finance)
-        total_bill = medicine_total
-        
-        # Note: Medicine costs are NOT added to finance
-        # Finance entries should be added manually via the Add Income button
+            # 3. Deduct from inventory (one UPDATE per distinct medicine) and save prescriptions
+            cursor.executemany(ADJUST_STOCK_SQL, [(-qty, item_id) for item_id, qty in stock_used.items()])
+            cursor.executemany(INSERT_PRESCRIPTION_SQL, [
+                (visit_id, items[med.inventory_id]["brand_name"], med.dosage or "As directed", "7 days", med.quantity, med.price)
+                for med in visit.medicines
+            ])
+            medicine_total = sum(med.price * med.quantity for med in visit.medicines)
+            
+            # 4. Calculate total bill (for display only, not added to finance)
+            total_bill = medicine_total
+            
+            # Note: Medicine costs are NOT added to finance
+            # Finance entries should be added manually via the Add Income button
         
-        conn.commit()
+        invalidate(("visits", "inventory"))
         
         return {
             "success": True,
@@ -659,22 +795,17 @@ async def create_visit(visit: VisitCreate):
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
 # ============ Inventory Routes ============
 
-@app.get("/api/inventory")
-async def get_inventory():
-    """Get all inventory items."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
+@api_router.get("/inventory")
+@cached(tables=("inventory",), ttl=None)
+def get_inventory(format: str = "columns", conn=Depends(get_db)):
+    """Get all inventory items (columnar unless format=aos)."""
     cursor = conn.cursor()
+    cursor.row_factory = None
     
     cursor.execute("""
         SELECT id, brand_name, formula, stock, price
@@ -682,28 +813,22 @@ async def get_inventory():
         ORDER BY brand_name
     """)
     
-    items = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return items
+    return fetch_rows(cursor, format)
 
 
-@app.get("/api/inventory/search")
-async def search_inventory(q: str = ""):
+@api_router.get("/inventory/search")
+def search_inventory(q: str = "", conn=Depends(get_db)):
     """Search inventory by brand name or formula."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     if q:
-        cursor.execute("""
+        match_sql, params = search_clause("inventory_fts", ("brand_name", "formula"), q)
+        cursor.execute(f"""
             SELECT id, brand_name, formula, stock, price
             FROM inventory
-            WHERE brand_name LIKE ? OR formula LIKE ?
+            WHERE {match_sql}
             ORDER BY brand_name
-        """, (f"%{q}%", f"%{q}%"))
+        """, params)
     else:
         cursor.execute("""
             SELECT id, brand_name, formula, stock, price
@@ -712,20 +837,13 @@ async def search_inventory(q: str = ""):
         """)
     
     items = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     return items
 
 
-@app.post("/api/inventory")
-async def create_inventory_item(request: Request):
+@api_router.post("/inventory")
+def create_inventory_item(data: dict = Body(...), conn=Depends(get_db)):
     """Add a new medicine to inventory."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    data = await request.json()
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -740,20 +858,14 @@ async def create_inventory_item(request: Request):
     
     item_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+    invalidate(("inventory",))
     
     return {"success": True, "id": item_id, "message": "Medicine added successfully"}
 
 
-@app.put("/api/inventory/{item_id}")
-async def update_inventory_item(item_id: int, request: Request):
+@api_router.put("/inventory/{item_id}")
+def update_inventory_item(item_id: int, data: dict = Body(...), conn=Depends(get_db)):
     """Update a medicine in inventory."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    data = await request.json()
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -768,74 +880,66 @@ async def update_inventory_item(item_id: int, request: Request):
     ))
     
     conn.commit()
-    conn.close()
+    invalidate(("inventory",))
     
     return {"success": True, "message": "Medicine updated successfully"}
 
 
-@app.post("/api/inventory/{item_id}/stock")
-async def add_stock(item_id: int, request: Request):
+@api_router.post("/inventory/{item_id}/stock")
+def add_stock(item_id: int, data: dict = Body(...), conn=Depends(get_db)):
     """Add stock to an inventory item and record expense."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    data = await request.json()
     quantity = data.get("quantity", 0)
     cost = data.get("cost", 0)
     notes = data.get("notes", "")
     
-    conn = get_connection()
     cursor = conn.cursor()
     today = date.today().isoformat()
     
+    # Get medicine name (checked before taking the write lock)
+    cursor.execute("SELECT brand_name FROM inventory WHERE id = ?", (item_id,))
+    item = cursor.fetchone()
+    if not item:
+        raise HTTPException(status_code=404, detail="Medicine not found")
+    
+    medicine_name = item["brand_name"]
+    
     try:
-        # Get medicine name
-        cursor.execute("SELECT brand_name FROM inventory WHERE id = ?", (item_id,))
-        item = cursor.fetchone()
-        if not item:
-            raise HTTPException(status_code=404, detail="Medicine not found")
-        
-        medicine_name = item["brand_name"]
-        
-        # Update stock
-        cursor.execute("""
-            UPDATE inventory SET stock = stock + ? WHERE id = ?
-        """, (quantity, item_id))
-        
-        # Add expense record to finance
-        if cost > 0:
-            expense_notes = f"Stock In: {medicine_name} x{quantity}"
-            if notes:
-                expense_notes += f" - {notes}"
+        # Stock update and expense entry commit together in one IMMEDIATE transaction
+        with conn:
+            cursor.execute("BEGIN IMMEDIATE")
             
-            cursor.execute("""
-                INSERT INTO finance (date, type, amount, notes)
-                VALUES (?, 'Expense', ?, ?)
-            """, (today, cost, expense_notes))
+            # Update stock
+            cursor.execute(ADJUST_STOCK_SQL, (quantity, item_id))
+            if cursor.rowcount == 0:
+                # Deleted between the check above and taking the lock
+                raise HTTPException(status_code=404, detail="Medicine not found")
+            
+            # Add expense record to finance
+            if cost > 0:
+                expense_notes = f"Stock In: {medicine_name} x{quantity}"
+                if notes:
+                    expense_notes += f" - {notes}"
+                
+                cursor.execute("""
+                    INSERT INTO finance (date, type, amount, notes)
+                    VALUES (?, 'Expense', ?, ?)
+                """, (today, cost, expense_notes))
         
-        conn.commit()
+        invalidate(("inventory", "finance"))
         return {"success": True, "message": "Stock added successfully"}
         
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
-@app.post("/api/inventory/{item_id}/stock-out")
-async def subtract_stock(item_id: int, request: Request):
+@api_router.post("/inventory/{item_id}/stock-out")
+def subtract_stock(item_id: int, data: dict = Body(...), conn=Depends(get_db)):
     """Subtract stock from an inventory item."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    data = await request.json()
     quantity = data.get("quantity", 0)
     notes = data.get("notes", "")
     
-    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -854,6 +958,7 @@ async def subtract_stock(item_id: int, request: Request):
         """, (quantity, item_id))
         
         conn.commit()
+        invalidate(("inventory",))
         return {"success": True, "message": "Stock subtracted successfully"}
         
     except HTTPException:
@@ -861,17 +966,11 @@ async def subtract_stock(item_id: int, request: Request):
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
-@app.delete("/api/inventory/{item_id}")
-async def delete_inventory_item(item_id: int):
+@api_router.delete("/inventory/{item_id}")
+def delete_inventory_item(item_id: int, conn=Depends(get_db)):
     """Delete a medicine from inventory."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -884,6 +983,7 @@ async def delete_inventory_item(item_id: int):
         cursor.execute("DELETE FROM inventory WHERE id = ?", (item_id,))
         
         conn.commit()
+        invalidate(("inventory",))
         return {"success": True, "message": "Medicine deleted successfully"}
         
     except HTTPException:
@@ -891,37 +991,31 @@ async def delete_inventory_item(item_id: int):
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
-@app.get("/api/search_medicine")
-async def search_medicine_with_alternatives(q: str = ""):
+@api_router.get("/search_medicine")
+def search_medicine_with_alternatives(q: str = "", conn=Depends(get_db)):
     """Search medicine and find alternatives with same formula if out of stock."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
     if not q:
         return {"searched_medicine": None, "alternatives": []}
     
-    conn = get_connection()
     cursor = conn.cursor()
     
     # Search for the medicine by brand name or formula
-    cursor.execute("""
+    match_sql, params = search_clause("inventory_fts", ("brand_name", "formula"), q)
+    cursor.execute(f"""
         SELECT id, brand_name, formula, stock, price
         FROM inventory
-        WHERE brand_name LIKE ? OR formula LIKE ?
+        WHERE {match_sql}
         ORDER BY 
             CASE WHEN brand_name LIKE ? THEN 0 ELSE 1 END,
             brand_name
         LIMIT 1
-    """, (f"%{q}%", f"%{q}%", f"%{q}%"))
+    """, (*params, f"%{q}%"))
     
     searched = cursor.fetchone()
     
     if not searched:
-        conn.close()
         return {"searched_medicine": None, "alternatives": []}
     
     searched_medicine = dict(searched)
@@ -938,8 +1032,6 @@ async def search_medicine_with_alternatives(q: str = ""):
         
         alternatives = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
-    
     return {
         "searched_medicine": searched_medicine,
         "alternatives": alternatives
@@ -949,7 +1041,7 @@ async def search_medicine_with_alternatives(q: str = ""):
 @app.get("/patients/new", response_class=HTMLResponse)
 async def new_patient_page(request: Request):
     """Redirect to patients page (modal handles new patient)."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return RedirectResponse(url="/patients", status_code=302)
 
@@ -957,7 +1049,7 @@ async def new_patient_page(request: Request):
 @app.get("/visits/new", response_class=HTMLResponse)
 async def new_visit_page(request: Request):
     """Redirect to patients page (modal handles new visit)."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return RedirectResponse(url="/patients", status_code=302)
 
@@ -967,11 +1059,11 @@ async def new_visit_page(request: Request):
 @app.get("/pharmacy", response_class=HTMLResponse)
 async def pharmacy_page(request: Request):
     """Serve the pharmacy/inventory management page."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return templates.TemplateResponse("pharmacy.html", {
         "request": request,
-        "user": session["user"]
+        "user": request.session["user"]
     })
 
 
@@ -980,32 +1072,30 @@ async def pharmacy_page(request: Request):
 @app.get("/finance", response_class=HTMLResponse)
 async def finance_page(request: Request):
     """Serve the finance management page."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return templates.TemplateResponse("finance.html", {
         "request": request,
-        "user": session["user"]
+        "user": request.session["user"]
     })
 
 
-@app.get("/api/finance/summary")
-async def get_finance_summary():
+@api_router.get("/finance/summary")
+@cached(tables=("finance",))
+def get_finance_summary(conn=Depends(get_db)):
     """Get total income, expenses, and net profit."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
-    # Get total income
-    cursor.execute("SELECT COALESCE(SUM(amount), 0) as total FROM finance WHERE type = 'Income'")
-    total_income = cursor.fetchone()["total"]
-    
-    # Get total expenses
-    cursor.execute("SELECT COALESCE(SUM(amount), 0) as total FROM finance WHERE type = 'Expense'")
-    total_expense = cursor.fetchone()["total"]
-    
-    conn.close()
+    # Get total income and expenses in one pass over finance
+    cursor.execute("""
+        SELECT type, COALESCE(SUM(amount), 0) as total
+        FROM finance
+        WHERE type IN ('Income', 'Expense')
+        GROUP BY type
+    """)
+    totals = {row["type"]: row["total"] for row in cursor.fetchall()}
+    total_income = totals.get("Income", 0)
+    total_expense = totals.get("Expense", 0)
     
     return {
         "total_income": total_income,
@@ -1014,15 +1104,9 @@ async def get_finance_summary():
     }
 
 
-@app.get("/api/finance")
-async def get_finance_transactions(type: str = "", date: str = "", month: str = ""):
+@api_router.get("/finance")
+def get_finance_transactions(type: str = "", date: str = "", month: str = ""):
     """Get all finance transactions with optional filters."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     # Build query with filters
     query = "SELECT id, date, type, amount, notes FROM finance WHERE 1=1"
     params = []
@@ -1035,27 +1119,28 @@ async def get_finance_transactions(type: str = "", date: str = "", month: str =
         query += " AND date = ?"
         params.append(date)
     elif month:
-        # Filter by month (YYYY-MM format)
-        query += " AND strftime('%Y-%m', date) = ?"
-        params.append(month)
+        # Filter by month (YYYY-MM format) as a date range so the index on date applies
+        try:
+            year, month_num = (int(part) for part in month.split("-"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Month must be in YYYY-MM format")
+        query += " AND date >= ? AND date < ?"
+        params.append(f"{year:04d}-{month_num:02d}-01")
+        params.append(f"{year + month_num // 12:04d}-{month_num % 12 + 1:02d}-01")
     
     query += " ORDER BY date DESC, id DESC"
     
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = None
     cursor.execute(query, params)
-    transactions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
-    return transactions
+    return StreamingResponse(close_after(conn, iter_json_rows(cursor)), media_type="application/json")
 
 
-@app.post("/api/finance")
-async def create_finance_transaction(request: Request):
+@api_router.post("/finance")
+def create_finance_transaction(data: dict = Body(...), conn=Depends(get_db)):
     """Add a manual finance transaction."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    data = await request.json()
-    
     transaction_type = data.get("type")
     if transaction_type not in ["Income", "Expense"]:
         raise HTTPException(status_code=400, detail="Type must be 'Income' or 'Expense'")
@@ -1064,7 +1149,6 @@ async def create_finance_transaction(request: Request):
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than 0")
     
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -1079,29 +1163,24 @@ async def create_finance_transaction(request: Request):
     
     transaction_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+    invalidate(("finance",))
     
     return {"success": True, "id": transaction_id, "message": "Transaction added successfully"}
 
 
-@app.delete("/api/finance/{transaction_id}")
-async def delete_finance_transaction(transaction_id: int):
+@api_router.delete("/finance/{transaction_id}")
+def delete_finance_transaction(transaction_id: int, conn=Depends(get_db)):
     """Delete a finance transaction."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     # Check if transaction exists
     cursor.execute("SELECT id FROM finance WHERE id = ?", (transaction_id,))
     if not cursor.fetchone():
-        conn.close()
         raise HTTPException(status_code=404, detail="Transaction not found")
     
     cursor.execute("DELETE FROM finance WHERE id = ?", (transaction_id,))
     conn.commit()
-    conn.close()
+    invalidate(("finance",))
     
     return {"success": True, "message": "Transaction deleted successfully"}
 
@@ -1111,21 +1190,48 @@ async def delete_finance_transaction(transaction_id: int):
 @app.get("/settings", response_class=HTMLResponse)
 async def settings_page(request: Request):
     """Serve the settings page."""
-    if not session.get("logged_in"):
+    if not request.session.get("logged_in"):
         return RedirectResponse(url="/", status_code=302)
     return templates.TemplateResponse("settings.html", {
         "request": request,
-        "user": session["user"]
+        "user": request.session["user"]
     })
 
 
-@app.get("/api/settings/info")
-async def get_system_info():
-    """Get system information for settings page."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
+def scan_backups():
+    """DirEntries of the Desktop backups, newest first (names embed the timestamp).
     
-    conn = get_connection()
+    os.scandir reads names straight from the directory listing and each entry
+    caches its stat() result, so every file is stat'd at most once.
+    """
+    try:
+        with os.scandir(Path.home() / "Desktop" / "Backups") as it:
+            entries = [e for e in it if e.name.startswith("backup_clinic_") and e.name.endswith(".db")]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda e: e.name, reverse=True)
+    return entries
+
+
+def last_backup_record():
+    """Path of the JSON file recording the latest backup (kept beside the database)."""
+    return get_db_path().parent / ".last_backup.json"
+
+
+def write_backup(backup_path):
+    """Snapshot the database to backup_path and record it as the latest backup."""
+    backup_path.parent.mkdir(parents=True, exist_ok=True)
+    backup_database(backup_path)
+    # Record it so the settings page doesn't have to scan the Backups folder
+    last_backup_record().write_bytes(orjson.dumps({
+        "path": str(backup_path),
+        "mtime": backup_path.stat().st_mtime
+    }))
+
+
+@api_router.get("/settings/info")
+def get_system_info(conn=Depends(get_db)):
+    """Get system information for settings page."""
     cursor = conn.cursor()
     
     # Get counts
@@ -1138,13 +1244,11 @@ async def get_system_info():
     cursor.execute("SELECT COUNT(*) as count FROM inventory")
     inventory_count = cursor.fetchone()["count"]
     
-    conn.close()
-    
     # Get database size
-    from database import DB_PATH
+    db_path = get_db_path()
     db_size = "--"
-    if DB_PATH.exists():
-        size_bytes = DB_PATH.stat().st_size
+    if db_path.exists():
+        size_bytes = db_path.stat().st_size
         if size_bytes < 1024:
             db_size = f"{size_bytes} B"
         elif size_bytes < 1024 * 1024:
@@ -1152,14 +1256,18 @@ async def get_system_info():
         else:
             db_size = f"{size_bytes / (1024 * 1024):.1f} MB"
     
-    # Check for last backup
+    # Check for last backup (recorded by create_backup; scan the folder only
+    # when there is no usable record, e.g. backups made by an older version)
     last_backup = None
-    desktop = Path.home() / "Desktop" / "Backups"
-    if desktop.exists():
-        backups = list(desktop.glob("backup_clinic_*.db"))
+    last_backup_mtime = None
+    try:
+        last_backup_mtime = orjson.loads(last_backup_record().read_bytes())["mtime"]
+    except (OSError, ValueError, KeyError):
+        backups = scan_backups()
         if backups:
-            latest = max(backups, key=lambda p: p.stat().st_mtime)
-            last_backup = datetime.fromtimestamp(latest.stat().st_mtime).strftime("%Y-%m-%d %H:%M")
+            last_backup_mtime = max(e.stat().st_mtime for e in backups)
+    if last_backup_mtime is not None:
+        last_backup = datetime.fromtimestamp(last_backup_mtime).strftime("%Y-%m-%d %H:%M")
     
     return {
         "db_size": db_size,
@@ -1170,30 +1278,27 @@ async def get_system_info():
     }
 
 
-@app.post("/api/settings/backup")
+@api_router.post("/settings/backup")
 async def create_backup():
     """Create a backup of the database."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    from database import DB_PATH
+    db_path = get_db_path()
     
     try:
-        # Create Backups folder on Desktop
+        # Backups folder on Desktop
         desktop = Path.home() / "Desktop"
         backup_folder = desktop / "Backups"
-        backup_folder.mkdir(parents=True, exist_ok=True)
         
         # Generate backup filename with current date
         current_date = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         backup_filename = f"backup_clinic_{current_date}.db"
         backup_path = backup_folder / backup_filename
         
-        # Copy the database file
-        if not DB_PATH.exists():
+        if not await asyncio.to_thread(db_path.exists):
             raise HTTPException(status_code=404, detail="Database file not found")
         
-        shutil.copy2(DB_PATH, backup_path)
+        # Snapshot the database (including pages still in the WAL file) in
+        # one worker-thread hop, keeping all of its disk I/O off the event loop
+        await asyncio.to_thread(write_backup, backup_path)
         
         return {
             "success": True,
@@ -1201,39 +1306,35 @@ async def create_backup():
             "backup_path": str(backup_path)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Backup failed: {str(e)}")
 
 
-@app.get("/api/settings/backups")
+@api_router.get("/settings/backups")
 async def list_backups():
     """List available backup files."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    desktop = Path.home() / "Desktop" / "Backups"
+    # A slow (e.g. network-mounted) Desktop must not block the event loop
+    entries = await asyncio.to_thread(scan_backups)
     backups = []
     
-    if desktop.exists():
-        for backup_file in sorted(desktop.glob("backup_clinic_*.db"), reverse=True):
-            stat = backup_file.stat()
-            backups.append({
-                "filename": backup_file.name,
-                "path": str(backup_file),
-                "size": f"{stat.st_size / 1024:.1f} KB",
-                "date": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M")
-            })
+    for entry in entries:
+        stat = entry.stat()
+        backups.append({
+            "filename": entry.name,
+            "path": entry.path,
+            "size": f"{stat.st_size / 1024:.1f} KB",
+            "date": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M")
+        })
     
     return backups
 
 
-@app.post("/api/settings/restore")
+@api_router.post("/settings/restore")
 async def restore_backup(request: Request):
     """Restore database from a backup file."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    from database import DB_PATH
+    db_path = get_db_path()
     
     data = await request.json()
     backup_path = data.get("backup_path")
@@ -1243,17 +1344,22 @@ async def restore_backup(request: Request):
     
     backup_file = Path(backup_path)
     
-    if not backup_file.exists():
+    if not await asyncio.to_thread(backup_file.exists):
         raise HTTPException(status_code=404, detail="Backup file not found")
     
     try:
         # Create a safety backup before restoring
-        safety_backup = DB_PATH.parent / f"pre_restore_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        if DB_PATH.exists():
-            shutil.copy2(DB_PATH, safety_backup)
+        safety_backup = db_path.parent / f"pre_restore_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+        if await asyncio.to_thread(db_path.exists):
+            await asyncio.to_thread(backup_database, safety_backup)
         
-        # Restore the backup
-        shutil.copy2(backup_file, DB_PATH)
+        # Restore the backup; requests wait meanwhile instead of reading a
+        # half-written database
+        await asyncio.to_thread(restore_database, backup_file)
+        # Bring an older backup's schema up to date and rebuild its stats
+        # and search tables from the restored data
+        await asyncio.to_thread(init_database, True)
+        invalidate()
         
         return {
             "success": True,
@@ -1266,15 +1372,68 @@ async def restore_backup(request: Request):
 
 
 # ============ Prescription Routes ============
-
-@app.get("/prescription/{visit_id}/print")
-async def print_prescription(visit_id: int):
-    """Generate and open prescription PDF for printing."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
+# Record-PDF rows, built once per row instead of a dict per row
+RecordVisit = namedtuple("RecordVisit", [
+    "id", "date", "vitals_bp", "vitals_weight", "vitals_temp", "vitals_bsr",
+    "vitals_spo2", "vitals_heart_rate", "presenting_complaint", "signs_symptoms",
+    "history_presenting_illness", "past_medical_hx", "family_history",
+    "examination", "differentials", "treatment_plan"
+])
+RecordRx = namedtuple("RecordRx", ["medicine_name", "dosage", "duration", "quantity"])
+RECORD_BATCH_SIZE = 200
+
+
+def iter_record_visits(conn, patient_id):
+    """Yield (visit, prescriptions) newest first, RECORD_BATCH_SIZE visits at a time.
+    
+    One query: SQLite nests each visit's prescriptions into a JSON array
+    (json_group_array) alongside the visit row.
+    """
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute("""
+        SELECT id, date, vitals_bp, vitals_weight, vitals_temp, vitals_bsr,
+            vitals_spo2, vitals_heart_rate, presenting_complaint, signs_symptoms,
+            history_presenting_illness, past_medical_hx, family_history,
+            examination, differentials, treatment_plan,
+            (SELECT json_group_array(json_array(medicine_name, dosage, duration, quantity))
+             FROM (SELECT medicine_name, dosage, duration, quantity
+                   FROM prescriptions
+                   WHERE visit_id = v.id
+                   ORDER BY id))
+        FROM visits v
+        WHERE patient_id = ?
+        ORDER BY date DESC
+    """, (patient_id,))
     
+    while batch := cursor.fetchmany(RECORD_BATCH_SIZE):
+        for *visit, rx_json in batch:
+            yield RecordVisit._make(visit), [RecordRx._make(rx) for rx in orjson.loads(rx_json)]
+
+
+def pdf_response(content: bytes, filename: str):
+    """Serve PDF bytes for the webview to display inline."""
+    return Response(
+        content=content,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'inline; filename="{filename}"'}
+    )
+
+
+@cached(tables=("visits", "patients"), ttl=None)
+def prescription_pdf_bytes(visit_id: int) -> bytes:
+    """Rendered prescription PDF; a visit's prescription never changes once written."""
+    return render_prescription_pdf(visit_id)
+
+
+@app.get("/prescription/{visit_id}/print", dependencies=[Depends(check_auth)])
+def print_prescription(visit_id: int, save: bool = False):
+    """Render the prescription PDF inline, or save a copy and open it with ?save=1."""
     try:
-        # Generate and open PDF
+        if not save:
+            return pdf_response(prescription_pdf_bytes(visit_id=visit_id), f"prescription_{visit_id}.pdf")
+        
+        # Save a copy and open it in the system viewer
         file_path = generate_and_open_prescription(visit_id)
         
         return {
@@ -1288,11 +1447,12 @@ async def print_prescription(visit_id: int):
         raise HTTPException(status_code=500, detail=f"Failed to generate prescription: {str(e)}")
 
 
-@app.post("/api/send-whatsapp")
+PHONE_STRIP = str.maketrans("", "", " -()+")
+
+
+@api_router.post("/send-whatsapp")
 async def send_whatsapp_message(request: Request):
     """Open WhatsApp with pre-filled message in system browser."""
-    import webbrowser
-    
     data = await request.json()
     phone = data.get("phone", "")
     message = data.get("message", "")
@@ -1300,57 +1460,70 @@ async def send_whatsapp_message(request: Request):
     if not phone:
         return {"success": False, "error": "No phone number provided"}
     
-    # Clean phone number
-    phone = phone.replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
+    # Clean phone number (spaces, dashes, brackets and "+" in one pass)
+    phone = phone.translate(PHONE_STRIP)
     
     # Handle Pakistan number format
     if phone.startswith("0"):
         phone = "92" + phone[1:]
-    if not phone.startswith("92") and not phone.startswith("+92"):
+    if not phone.startswith("92"):
         phone = "92" + phone
-    phone = phone.replace("+", "")
     
     # Create WhatsApp URL
-    from urllib.parse import quote
     encoded_message = quote(message)
     whatsapp_url = f"https://wa.me/{phone}?text={encoded_message}"
     
     # Open in system browser
     try:
-        webbrowser.open(whatsapp_url)
+        await asyncio.to_thread(webbrowser.open, whatsapp_url)
         return {"success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
-@app.get("/api/visits/{visit_id}/prescriptions")
-async def get_visit_prescriptions(visit_id: int):
-    """Get prescriptions for a specific visit."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
+@api_router.get("/visits/{visit_id}/prescriptions")
+def get_visit_prescriptions(visit_id: int, limit: Optional[int] = Query(None, ge=1, le=500),
+                            after_id: int = 0, conn=Depends(get_db)):
+    """Get prescriptions for a specific visit.
     
-    conn = get_connection()
+    Without limit, returns them all as a list. With limit (1-500), returns one page as
+    {"prescriptions": [...], "next_cursor": id}; pass next_cursor back as
+    after_id for the next page (null when there are no more).
+    
+    Returned as ORJSONResponse so orjson encodes the rows directly, skipping
+    FastAPI's jsonable_encoder walk over every value.
+    """
     cursor = conn.cursor()
+    cursor.row_factory = None
+    
+    if limit is None:
+        cursor.execute("""
+            SELECT medicine_name, dosage, duration, quantity, price
+            FROM prescriptions
+            WHERE visit_id = ?
+            ORDER BY id
+        """, (visit_id,))
+        return ORJSONResponse(fetch_rows(cursor, format="aos"))
     
+    # Keyset page: idx_prescriptions_visit_id is ordered by (visit_id, id)
     cursor.execute("""
-        SELECT medicine_name, dosage, duration, quantity, price
+        SELECT id, medicine_name, dosage, duration, quantity, price
         FROM prescriptions
-        WHERE visit_id = ?
-    """, (visit_id,))
-    
-    prescriptions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return prescriptions
+        WHERE visit_id = ? AND id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (visit_id, after_id, limit))
+    prescriptions = fetch_rows(cursor, format="aos")
+    
+    return ORJSONResponse({
+        "prescriptions": prescriptions,
+        "next_cursor": prescriptions[-1]["id"] if prescriptions and len(prescriptions) == limit else None
+    })
 
 
-@app.get("/api/prescription/{visit_id}")
-async def get_prescription_data(visit_id: int):
+@api_router.get("/prescription/{visit_id}")
+def get_prescription_data(visit_id: int, conn=Depends(get_db)):
     """Get prescription data for a visit."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -1364,61 +1537,33 @@ async def get_prescription_data(visit_id: int):
     """, (visit_id,))
     
     visit = cursor.fetchone()
-    conn.close()
     
     if not visit:
         raise HTTPException(status_code=404, detail="Visit not found")
     
-    return dict(visit)
+    return ORJSONResponse(dict(visit))
 
 
-@app.get("/api/patients/{patient_id}/pdf")
-async def generate_patient_record_pdf(patient_id: int):
-    """Generate and open complete patient record PDF."""
-    if not session.get("logged_in"):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
+@api_router.get("/patients/{patient_id}/pdf")
+def generate_patient_record_pdf(patient_id: int, save: bool = False, conn=Depends(get_db)):
+    """Render the complete patient record PDF inline, or save a copy and open it with ?save=1."""
     try:
-        from fpdf import FPDF
-        import subprocess
-        import platform
-        
-        conn = get_connection()
         cursor = conn.cursor()
         
-        # Get patient details
-        cursor.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
+        # Get patient details, plus the visit count the header needs up front
+        # (the visits themselves are rendered batch by batch below)
+        cursor.execute("""
+            SELECT *, (SELECT COUNT(*) FROM visits WHERE patient_id = p.id) AS visit_count
+            FROM patients p
+            WHERE id = ?
+        """, (patient_id,))
         patient = cursor.fetchone()
         
         if not patient:
-            conn.close()
             raise HTTPException(status_code=404, detail="Patient not found")
         
         patient = dict(patient)
-        
-        # Get all visits with prescriptions
-        cursor.execute("""
-            SELECT id, date, vitals_bp, vitals_weight, vitals_temp, vitals_bsr,
-                vitals_spo2, vitals_heart_rate, presenting_complaint, signs_symptoms,
-                history_presenting_illness, past_medical_hx, family_history,
-                examination, differentials, treatment_plan
-            FROM visits
-            WHERE patient_id = ?
-            ORDER BY date DESC
-        """, (patient_id,))
-        
-        visits = []
-        for visit_row in cursor.fetchall():
-            visit = dict(visit_row)
-            cursor.execute("""
-                SELECT medicine_name, dosage, duration, quantity
-                FROM prescriptions
-                WHERE visit_id = ?
-            """, (visit['id'],))
-            visit['prescriptions'] = [dict(p) for p in cursor.fetchall()]
-            visits.append(visit)
-        
-        conn.close()
+        visit_count = patient['visit_count']
         
         # Create PDF
         pdf = FPDF()
@@ -1464,65 +1609,63 @@ async def generate_patient_record_pdf(patient_id: int):
         pdf.set_fill_color(0, 31, 63)
         pdf.set_text_color(255, 255, 255)
         pdf.set_font('Helvetica', 'B', 12)
-        pdf.cell(0, 10, f' Medical Records ({len(visits)} visits)', new_x='LMARGIN', new_y='NEXT', align='L', fill=True)
+        pdf.cell(0, 10, f' Medical Records ({visit_count} visits)', new_x='LMARGIN', new_y='NEXT', align='L', fill=True)
         pdf.set_text_color(0, 0, 0)
         pdf.ln(3)
         
-        for i, visit in enumerate(visits):
+        for i, (visit, prescriptions) in enumerate(iter_record_visits(conn, patient_id)):
             # Check if we need a new page
             if pdf.get_y() > 230:
                 pdf.add_page()
             
             pdf.set_font('Helvetica', 'B', 11)
             pdf.set_text_color(0, 31, 63)
-            pdf.cell(0, 8, f"Visit {len(visits) - i}: {visit['date']}", new_x='LMARGIN', new_y='NEXT')
+            pdf.cell(0, 8, f"Visit {visit_count - i}: {visit.date}", new_x='LMARGIN', new_y='NEXT')
             
             pdf.set_font('Helvetica', '', 10)
             pdf.set_text_color(0, 0, 0)
             
             # Vitals
-            vitals = []
-            if visit.get('vitals_bp'): vitals.append(f"BP: {visit['vitals_bp']}")
-            if visit.get('vitals_weight'): vitals.append(f"Weight: {visit['vitals_weight']}kg")
-            if visit.get('vitals_temp'): vitals.append(f"Temp: {visit['vitals_temp']}F")
-            if visit.get('vitals_bsr'): vitals.append(f"BSR: {visit['vitals_bsr']}")
-            if visit.get('vitals_spo2'): vitals.append(f"SPO2: {visit['vitals_spo2']}")
-            if visit.get('vitals_heart_rate'): vitals.append(f"HR: {visit['vitals_heart_rate']}")
+            vitals = [
+                f"{label}: {value}{unit}"
+                for label, value, unit in zip(VITAL_LABELS_LONG, get_vitals(visit), VITAL_UNITS)
+                if value
+            ]
             
             if vitals:
                 vitals_text = "Vitals: " + " | ".join(vitals)
                 pdf.multi_cell(0, 6, vitals_text)
             
-            complaint = visit.get('presenting_complaint')
+            complaint = visit.presenting_complaint
             if complaint:
                 pdf.set_x(10)
                 pdf.multi_cell(0, 5, f"Complaint: {str(complaint)[:200]}")
             
-            symptoms = visit.get('signs_symptoms')
+            symptoms = visit.signs_symptoms
             if symptoms:
                 pdf.set_x(10)
                 pdf.multi_cell(0, 5, f"Signs & Symptoms: {str(symptoms)[:200]}")
             
-            differentials = visit.get('differentials')
+            differentials = visit.differentials
             if differentials:
                 pdf.set_x(10)
                 pdf.multi_cell(0, 5, f"Differential Diagnosis: {str(differentials)[:200]}")
             
-            treatment = visit.get('treatment_plan')
+            treatment = visit.treatment_plan
             if treatment:
                 pdf.set_x(10)
                 pdf.multi_cell(0, 5, f"Treatment Plan: {str(treatment)[:200]}")
             
             # Prescriptions
-            if visit.get('prescriptions'):
+            if prescriptions:
                 pdf.set_font('Helvetica', 'I', 10)
                 pdf.set_x(10)
                 pdf.multi_cell(0, 6, "Prescription:")
-                for rx in visit['prescriptions']:
-                    med_name = str(rx.get('medicine_name', '') or '')[:40]
-                    qty = str(rx.get('quantity', '') or '')
-                    dosage = str(rx.get('dosage', '') or '')[:25]
-                    duration = str(rx.get('duration', '') or '')[:20]
+                for rx in prescriptions:
+                    med_name = str(rx.medicine_name or '')[:40]
+                    qty = str(rx.quantity or '')
+                    dosage = str(rx.dosage or '')[:25]
+                    duration = str(rx.duration or '')[:20]
                     rx_text = f"  - {med_name} (Qty: {qty}) {dosage} {duration}"
                     pdf.set_x(10)
                     pdf.multi_cell(0, 5, rx_text)
@@ -1533,10 +1676,13 @@ async def generate_patient_record_pdf(patient_id: int):
             pdf.line(10, pdf.get_y(), 200, pdf.get_y())
             pdf.ln(3)
         
+        filename = f"patient_{patient_id}_record_{date.today().isoformat()}.pdf"
+        if not save:
+            return pdf_response(bytes(pdf.output()), filename)
+        
         # Save PDF
         output_dir = Path("output")
         output_dir.mkdir(exist_ok=True)
-        filename = f"patient_{patient_id}_record_{date.today().isoformat()}.pdf"
         file_path = output_dir / filename
         pdf.output(str(file_path))
         
@@ -1554,15 +1700,37 @@ async def generate_patient_record_pdf(patient_id: int):
             "file_path": str(file_path)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate PDF: {str(e)}")
 
 
+# Register the /api routes (must come after they are all declared above)
+app.include_router(api_router)
+
+
 # ============ PyWebView Desktop Launcher ============
 
+HOST = "127.0.0.1"
+PORT = 8000
+
+
 def start_server():
     """Start the FastAPI server."""
-    uvicorn.run(app, host="127.0.0.1", port=8000, log_level="warning")
+    uvicorn.run(app, host=HOST, port=PORT, log_level="warning")
+
+
+def wait_for_server(timeout=5.0):
+    """Block until the server accepts connections (or timeout seconds pass)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, PORT), timeout=0.05):
+                return True
+        except OSError:
+            time.sleep(0.01)
+    return False
 
 
 if __name__ == "__main__":
@@ -1573,14 +1741,13 @@ if __name__ == "__main__":
     server_thread = threading.Thread(target=start_server, daemon=True)
     server_thread.start()
     
-    # Give the server a moment to start
-    import time
-    time.sleep(1)
+    # Open the window as soon as the server is up
+    wait_for_server()
     
     # Create and start PyWebView window in fullscreen
     webview.create_window(
         title="DrKhan System",
-        url="http://127.0.0.1:8000",
+        url=f"http://{HOST}:{PORT}",
         fullscreen=True,
         resizable=True,
         min_size=(800, 600)
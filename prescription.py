@@ -7,6 +7,8 @@ import os
 import sys
 import subprocess
 import platform
+from collections import namedtuple
+from operator import attrgetter
 from pathlib import Path
 from datetime import datetime
 from fpdf import FPDF
@@ -30,6 +32,23 @@ def get_output_dir():
     return output_dir
 
 
+# Vitals as printed by both PDFs: row field, label (short / long) and unit
+VITAL_FIELDS = ("vitals_bp", "vitals_weight", "vitals_temp", "vitals_bsr", "vitals_spo2", "vitals_heart_rate")
+VITAL_LABELS = ("BP", "Wt", "Temp", "BSR", "SPO2", "HR")
+VITAL_LABELS_LONG = ("BP", "Weight", "Temp", "BSR", "SPO2", "HR")
+VITAL_UNITS = ("", "kg", "F", "", "", "")
+VITAL_CELL_WIDTHS = (32, 32, 32, 32, 32, 28)
+get_vitals = attrgetter(*VITAL_FIELDS)
+
+# Visit query row, built once instead of a dict
+PrescriptionVisit = namedtuple("PrescriptionVisit", [
+    "id", "date",
+    "vitals_bp", "vitals_weight", "vitals_temp", "vitals_bsr", "vitals_spo2", "vitals_heart_rate",
+    "presenting_complaint", "signs_symptoms", "differentials", "treatment_plan",
+    "patient_id", "patient_name", "age", "gender", "contact"
+])
+
+
 class PrescriptionPDF(FPDF):
     """Custom PDF class for prescriptions."""
     
@@ -76,18 +95,47 @@ class PrescriptionPDF(FPDF):
         self.cell(0, 5, "Doctor's Signature", align='R')
 
 
-def generate_prescription_pdf(visit_id: int) -> str:
+# Medicines table rows; a row may start at most this far down the page
+# (leaves space for the footer)
+RX_ROW_HEIGHT = 7
+RX_LAST_ROW_Y = 240
+
+
+def draw_rx_table_header(pdf):
+    """Draw the medicines table header row, then switch to the row style."""
+    pdf.set_fill_color(0, 31, 63)
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font('Helvetica', 'B', 10)
+    
+    pdf.cell(10, 8, '#', border=1, align='C', fill=True)
+    pdf.cell(70, 8, 'Medicine', border=1, align='C', fill=True)
+    pdf.cell(15, 8, 'Qty', border=1, align='C', fill=True)
+    pdf.cell(50, 8, 'Dosage', border=1, align='C', fill=True)
+    pdf.cell(45, 8, 'Duration', border=1, align='C', fill=True)
+    pdf.ln()
+    
+    pdf.set_text_color(50, 50, 50)
+    pdf.set_font('Helvetica', '', 9)
+
+
+def rx_rows_that_fit(pdf):
+    """How many table rows fit on the current page from the current y."""
+    return max(0, int((RX_LAST_ROW_Y - pdf.get_y()) // RX_ROW_HEIGHT) + 1)
+
+
+def build_prescription_pdf(visit_id: int) -> PrescriptionPDF:
     """
-    Generate a prescription PDF for a visit.
+    Lay out the prescription PDF for a visit in memory.
     
     Args:
         visit_id: The ID of the visit
         
     Returns:
-        Path to the generated PDF file
+        The rendered PrescriptionPDF document
     """
     conn = get_connection()
     cursor = conn.cursor()
+    cursor.row_factory = None
     
     # Get visit details with patient info (using correct column names)
     cursor.execute("""
@@ -107,16 +155,17 @@ def generate_prescription_pdf(visit_id: int) -> str:
         conn.close()
         raise ValueError(f"Visit {visit_id} not found")
     
-    visit = dict(visit)
+    visit = PrescriptionVisit._make(visit)
     
-    # Get prescriptions for this visit
+    # Get prescriptions for this visit, already cut to the table's column widths
     cursor.execute("""
-        SELECT medicine_name, dosage, duration, quantity, price
+        SELECT substr(medicine_name, 1, 35), coalesce(CAST(quantity AS TEXT), ''),
+            substr(coalesce(dosage, 'As directed'), 1, 25), substr(coalesce(duration, ''), 1, 20)
         FROM prescriptions
         WHERE visit_id = ?
         ORDER BY id
     """, (visit_id,))
-    medicines = [dict(row) for row in cursor.fetchall()]
+    medicines = cursor.fetchall()
     
     conn.close()
     
@@ -137,20 +186,20 @@ def generate_prescription_pdf(visit_id: int) -> str:
     
     # Left column
     pdf.set_x(15)
-    patient_name = visit.get('patient_name', 'N/A') or 'N/A'
+    patient_name = visit.patient_name or 'N/A'
     pdf.cell(90, 5, f"Patient: {patient_name}", new_x='LMARGIN', new_y='NEXT')
     pdf.set_x(15)
-    age = visit.get('age', 'N/A') or 'N/A'
-    gender = visit.get('gender', '') or ''
+    age = visit.age or 'N/A'
+    gender = visit.gender or ''
     pdf.cell(90, 5, f"Age: {age} years  |  Gender: {gender}", new_x='LMARGIN', new_y='NEXT')
     
     # Right column
     pdf.set_y(y_start)
     pdf.set_x(120)
-    visit_date = visit.get('date', 'N/A') or 'N/A'
+    visit_date = visit.date or 'N/A'
     pdf.cell(80, 5, f"Date: {visit_date}", new_x='LMARGIN', new_y='NEXT')
     pdf.set_x(120)
-    pdf.cell(80, 5, f"Visit ID: #{visit.get('id', 'N/A')}", new_x='LMARGIN', new_y='NEXT')
+    pdf.cell(80, 5, f"Visit ID: #{visit.id}", new_x='LMARGIN', new_y='NEXT')
     
     pdf.set_y(y_start + 22)
     pdf.ln(5)
@@ -168,24 +217,13 @@ def generate_prescription_pdf(visit_id: int) -> str:
     pdf.set_font('Helvetica', '', 9)
     pdf.set_text_color(50, 50, 50)
     
-    bp = visit.get('vitals_bp') or '-'
-    weight = f"{visit.get('vitals_weight')}kg" if visit.get('vitals_weight') else '-'
-    temp = f"{visit.get('vitals_temp')}F" if visit.get('vitals_temp') else '-'
-    bsr = visit.get('vitals_bsr') or '-'
-    spo2 = visit.get('vitals_spo2') or '-'
-    hr = visit.get('vitals_heart_rate') or '-'
-    
     pdf.set_x(12)
-    pdf.cell(32, 6, f"BP: {bp}", align='L')
-    pdf.cell(32, 6, f"Wt: {weight}", align='L')
-    pdf.cell(32, 6, f"Temp: {temp}", align='L')
-    pdf.cell(32, 6, f"BSR: {bsr}", align='L')
-    pdf.cell(32, 6, f"SPO2: {spo2}", align='L')
-    pdf.cell(28, 6, f"HR: {hr}", align='L')
+    for label, value, unit, width in zip(VITAL_LABELS, get_vitals(visit), VITAL_UNITS, VITAL_CELL_WIDTHS):
+        pdf.cell(width, 6, f"{label}: {value}{unit}" if value else f"{label}: -", align='L')
     pdf.ln(15)
     
     # Presenting Complaint
-    complaint = visit.get('presenting_complaint')
+    complaint = visit.presenting_complaint
     if complaint:
         pdf.set_font('Helvetica', 'B', 11)
         pdf.set_text_color(0, 31, 63)
@@ -196,7 +234,7 @@ def generate_prescription_pdf(visit_id: int) -> str:
         pdf.ln(3)
     
     # Differential Diagnosis
-    differentials = visit.get('differentials')
+    differentials = visit.differentials
     if differentials:
         pdf.set_font('Helvetica', 'B', 11)
         pdf.set_text_color(0, 31, 63)
@@ -207,7 +245,7 @@ def generate_prescription_pdf(visit_id: int) -> str:
         pdf.ln(3)
     
     # Treatment Plan
-    treatment = visit.get('treatment_plan')
+    treatment = visit.treatment_plan
     if treatment:
         pdf.set_font('Helvetica', 'B', 11)
         pdf.set_text_color(0, 31, 63)
@@ -223,62 +261,53 @@ def generate_prescription_pdf(visit_id: int) -> str:
     pdf.set_text_color(0, 31, 63)
     pdf.cell(0, 8, 'Rx', new_x='LMARGIN', new_y='NEXT')
     
-    # Medicine table header
-    pdf.set_fill_color(0, 31, 63)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font('Helvetica', 'B', 10)
-    
-    pdf.cell(10, 8, '#', border=1, align='C', fill=True)
-    pdf.cell(70, 8, 'Medicine', border=1, align='C', fill=True)
-    pdf.cell(15, 8, 'Qty', border=1, align='C', fill=True)
-    pdf.cell(50, 8, 'Dosage', border=1, align='C', fill=True)
-    pdf.cell(45, 8, 'Duration', border=1, align='C', fill=True)
-    pdf.ln()
-    
-    # Medicine table rows
-    pdf.set_text_color(50, 50, 50)
-    pdf.set_font('Helvetica', '', 9)
-    
-    row_height = 7
+    draw_rx_table_header(pdf)
     
     if medicines:
-        for i, med in enumerate(medicines, 1):
-            # Check if we need a new page (leave space for footer)
-            if pdf.get_y() > 240:
+        rows_left = rx_rows_that_fit(pdf)
+        for i, (med_name, qty, dosage, duration) in enumerate(medicines, 1):
+            # New page (with the table header again) once this one is full
+            if not rows_left:
                 pdf.add_page()
-                # Re-draw table header on new page
-                pdf.set_fill_color(0, 31, 63)
-                pdf.set_text_color(255, 255, 255)
-                pdf.set_font('Helvetica', 'B', 10)
-                pdf.cell(10, 8, '#', border=1, align='C', fill=True)
-                pdf.cell(70, 8, 'Medicine', border=1, align='C', fill=True)
-                pdf.cell(15, 8, 'Qty', border=1, align='C', fill=True)
-                pdf.cell(50, 8, 'Dosage', border=1, align='C', fill=True)
-                pdf.cell(45, 8, 'Duration', border=1, align='C', fill=True)
-                pdf.ln()
-                pdf.set_text_color(50, 50, 50)
-                pdf.set_font('Helvetica', '', 9)
+                draw_rx_table_header(pdf)
+                rows_left = rx_rows_that_fit(pdf)
+            rows_left -= 1
             
             if i % 2 == 0:
                 pdf.set_fill_color(255, 255, 255)
             else:
                 pdf.set_fill_color(248, 249, 250)
             
-            med_name = str(med.get('medicine_name', ''))[:35]
-            qty = str(med.get('quantity', ''))
-            dosage = str(med.get('dosage', 'As directed'))[:25]
-            duration = str(med.get('duration', ''))[:20]
-            
-            pdf.cell(10, row_height, str(i), border=1, align='C', fill=True)
-            pdf.cell(70, row_height, med_name, border=1, align='L', fill=True)
-            pdf.cell(15, row_height, qty, border=1, align='C', fill=True)
-            pdf.cell(50, row_height, dosage, border=1, align='C', fill=True)
-            pdf.cell(45, row_height, duration, border=1, align='C', fill=True)
+            pdf.cell(10, RX_ROW_HEIGHT, str(i), border=1, align='C', fill=True)
+            pdf.cell(70, RX_ROW_HEIGHT, med_name, border=1, align='L', fill=True)
+            pdf.cell(15, RX_ROW_HEIGHT, qty, border=1, align='C', fill=True)
+            pdf.cell(50, RX_ROW_HEIGHT, dosage, border=1, align='C', fill=True)
+            pdf.cell(45, RX_ROW_HEIGHT, duration, border=1, align='C', fill=True)
             pdf.ln()
     else:
         pdf.cell(190, 8, 'No medicines prescribed', border=1, align='C')
         pdf.ln()
     
+    return pdf
+
+
+def render_prescription_pdf(visit_id: int) -> bytes:
+    """Render a visit's prescription PDF to bytes (nothing is written to disk)."""
+    return bytes(build_prescription_pdf(visit_id).output())
+
+
+def generate_prescription_pdf(visit_id: int) -> str:
+    """
+    Generate a prescription PDF for a visit and save it to the output directory.
+    
+    Args:
+        visit_id: The ID of the visit
+        
+    Returns:
+        Path to the generated PDF file
+    """
+    pdf = build_prescription_pdf(visit_id)
+    
     # Generate output path
     output_dir = get_output_dir()
     
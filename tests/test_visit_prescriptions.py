@@ -0,0 +1,71 @@
+"""
+Tests for GET /api/visits/{visit_id}/prescriptions keyset pagination.
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+from database import INSERT_PRESCRIPTION_SQL
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    """Logged-in client on a throwaway database with one 5-medicine visit."""
+    database.DB_PATH = tmp_path_factory.mktemp("db") / "clinic.db"
+    database.init_database()
+
+    conn = database.get_connection()
+    patient_id = conn.execute("INSERT INTO patients (name) VALUES ('Test Patient')").lastrowid
+    visit_id = conn.execute(
+        "INSERT INTO visits (patient_id, date) VALUES (?, '2024-01-01')", (patient_id,)
+    ).lastrowid
+    conn.executemany(INSERT_PRESCRIPTION_SQL, [
+        (visit_id, f"Medicine {i}", "1+0+1", "5 days", 1, 10.0) for i in range(5)
+    ])
+    conn.commit()
+    conn.close()
+
+    import main
+    with TestClient(main.app) as c:
+        c.post("/login", json={"username": "admin", "password": "123"})
+        c.visit_id = visit_id
+        yield c
+
+
+def get_page(client, **params):
+    response = client.get(f"/api/visits/{client.visit_id}/prescriptions", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_without_limit_returns_every_row(client):
+    rows = get_page(client)
+    assert [r["medicine_name"] for r in rows] == [f"Medicine {i}" for i in range(5)]
+
+
+@pytest.mark.parametrize("limit", [0, -1, 501])
+def test_out_of_range_limit_is_rejected(client, limit):
+    response = client.get(f"/api/visits/{client.visit_id}/prescriptions", params={"limit": limit})
+    assert response.status_code == 422
+
+
+def test_pages_walk_to_a_short_last_page(client):
+    names, after_id, pages = [], 0, 0
+    while True:
+        page = get_page(client, limit=2, after_id=after_id)
+        pages += 1
+        names += [r["medicine_name"] for r in page["prescriptions"]]
+        if page["next_cursor"] is None:
+            break
+        after_id = page["next_cursor"]
+    assert pages == 3
+    assert names == [f"Medicine {i}" for i in range(5)]
+
+
+def test_empty_last_page_has_no_cursor(client):
+    # A full page can't tell there is nothing after it; the next one is empty
+    first = get_page(client, limit=5)
+    assert len(first["prescriptions"]) == 5
+    last = get_page(client, limit=5, after_id=first["next_cursor"])
+    assert last == {"prescriptions": [], "next_cursor": None}